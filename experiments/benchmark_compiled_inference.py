@@ -0,0 +1,54 @@
+"""
+Per-token latency of the eager GenerationEngine against the TorchScript graphs of --compile.
+The first compiled run traces the graphs (or loads them from data/cache/compiled_models),
+one warm-up batch runs before timing so the shape specializations of the buckets are in place.
+Takes the arguments of src/main.py:
+
+    python experiments/benchmark_compiled_inference.py \
+        --img_type detr --prompt_format QCM-LE --output_len 512 --eval_bs 8 \
+        --model models/MM-CoT-UnifiedQA-base-Rationale --test_split minitest
+"""
+
+import json
+
+from src.data.batching import get_evaluation_dataloader
+from src.main import args, cot_map
+from src.models.t5_multimodal_generation.compiled_generation import \
+    CompiledGenerationEngine
+from src.models.t5_multimodal_generation.generation import GenerationEngine
+
+if __name__ == '__main__':
+
+    cot = cot_map.get(args.dataset)()
+    num_samples = len(cot.test_set)
+
+    engines = {
+        "eager": GenerationEngine.from_args(args, cot.model, cot.tokenizer),
+        "compiled": CompiledGenerationEngine.from_args(args, cot.model, cot.tokenizer),
+    }
+
+    results = {}
+    predictions = {}
+    for name, engine in engines.items():
+        warmup = next(iter(get_evaluation_dataloader(cot.test_set, args.eval_bs)))
+        engine.generate(warmup)
+        engine.reset_stats()
+
+        predictions[name] = engine.run(
+            get_evaluation_dataloader(cot.test_set, args.eval_bs), num_samples)
+        report = engine.report()
+        results[name] = {
+            "seconds": report["seconds"],
+            "ms_per_token": round(1000 * report["seconds"] / max(report["generated_tokens"], 1), 3),
+            "tokens_per_second": report["tokens_per_second"],
+            "samples_per_second": report["samples_per_second"],
+        }
+        if "compile_seconds" in report:
+            results[name]["compile_seconds"] = report["compile_seconds"]
+
+    results["speedup"] = round(results["eager"]["seconds"] / max(results["compiled"]["seconds"], 1e-9), 2)
+    results["same_predictions"] = sum(
+        eager == compiled for eager, compiled in zip(predictions["eager"], predictions["compiled"]))
+    results["number_of_examples"] = num_samples
+
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,37 @@
+"""
+Rationales/second of continuous batching against static batching on the test set.
+Takes the arguments of src/main.py, e.g.
+
+    python experiments/benchmark_continuous_batching.py \
+        --img_type detr --prompt_format QCM-LE --output_len 512 --eval_bs 8 \
+        --model models/MM-CoT-UnifiedQA-base-Rationale
+"""
+
+import json
+
+from src.data.batching import get_evaluation_dataloader
+from src.main import args, cot_map
+from src.models.t5_multimodal_generation.continuous_batching import \
+    ContinuousBatchingEngine
+from src.models.t5_multimodal_generation.generation import GenerationEngine
+
+if __name__ == '__main__':
+
+    cot = cot_map.get(args.dataset)()
+    num_samples = len(cot.test_set)
+
+    results = {}
+    predictions = {}
+    for name, engine_class in (("static", GenerationEngine), ("continuous", ContinuousBatchingEngine)):
+        engine = engine_class.from_args(args, cot.model, cot.tokenizer)
+        predictions[name] = engine.run(
+            get_evaluation_dataloader(cot.test_set, args.eval_bs), num_samples)
+        results[name] = engine.report()
+
+    results["speedup"] = round(
+        results["continuous"]["samples_per_second"] / max(results["static"]["samples_per_second"], 1e-9), 2)
+    results["same_predictions"] = sum(
+        static == continuous for static, continuous in zip(predictions["static"], predictions["continuous"]))
+    results["number_of_examples"] = num_samples
+
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,47 @@
+"""
+Accuracy (QCM-A) or ROUGE-L (QCM-LE) against latency of the fp32 and the int8 model on CPU.
+Takes the arguments of src/main.py, use the ScienceQA minitest split for a quick comparison:
+
+    python experiments/benchmark_quantization.py \
+        --img_type detr --prompt_format QCM-A --output_len 64 --eval_bs 8 \
+        --model models/MM-CoT-UnifiedQA-base-Answer --test_split minitest
+"""
+
+import copy
+import json
+
+from src.data.batching import get_evaluation_dataloader
+from src.main import args, cot_map
+from src.models.t5_multimodal_generation.generation import GenerationEngine
+from src.models.t5_multimodal_generation.training_params import get_t5_model
+
+if __name__ == '__main__':
+
+    cot = cot_map.get(args.dataset)()
+    num_samples = len(cot.test_set)
+    targets = list(cot.test_set.plain_targets)
+
+    quantized_args = copy.copy(args)
+    quantized_args.quantize = True
+    models = {
+        "fp32": cot.model,
+        "int8": get_t5_model(quantized_args, cot.tokenizer, cot.save_dir),
+    }
+
+    results = {}
+    for name, model in models.items():
+        engine = GenerationEngine.from_args(args, model, cot.tokenizer)
+        predictions = engine.run(
+            get_evaluation_dataloader(cot.test_set, args.eval_bs), num_samples)
+        report = engine.report()
+        results[name] = {
+            **cot._compute_metrics(predictions, targets),
+            "seconds": report["seconds"],
+            "ms_per_sample": round(1000 * report["seconds"] / num_samples, 2),
+            "tokens_per_second": report["tokens_per_second"],
+        }
+
+    results["speedup"] = round(results["fp32"]["seconds"] / max(results["int8"]["seconds"], 1e-9), 2)
+    results["number_of_examples"] = num_samples
+
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,69 @@
+"""
+Load test for src/server.py on localhost.
+
+    python experiments/load_test_server.py --url http://127.0.0.1:8000 --requests 200 --concurrency 16
+"""
+
+import argparse
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+SAMPLE = {
+    "question": "Which of these states is farthest north?",
+    "context": "",
+    "options": ["West Virginia", "Louisiana", "Arizona", "Oklahoma"]
+}
+
+
+def post(url, payload):
+    request = urllib.request.Request(
+        f"{url}/infer",
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"}
+    )
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        result = json.loads(response.read())
+    return (time.perf_counter() - start) * 1000, result
+
+
+def get(url, path):
+    with urllib.request.urlopen(f"{url}{path}") as response:
+        return json.loads(response.read())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8000')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--sample', type=str, default=None, help='JSON file with the sample to send')
+    args = parser.parse_args()
+
+    sample = SAMPLE
+    if args.sample:
+        with open(args.sample, "r") as f:
+            sample = json.load(f)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        responses = list(executor.map(lambda _: post(args.url, sample), range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in responses])
+    batch_sizes = np.array([result["batch_size"] for _, result in responses])
+
+    print(json.dumps({
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "requests_per_second": round(args.requests / elapsed, 2),
+        "latency_ms_p50": round(float(np.percentile(latencies, 50)), 2),
+        "latency_ms_p95": round(float(np.percentile(latencies, 95)), 2),
+        "latency_ms_p99": round(float(np.percentile(latencies, 99)), 2),
+        "mean_batch_size": round(float(batch_sizes.mean()), 2),
+        "server": get(args.url, "/health")
+    }, indent=2))
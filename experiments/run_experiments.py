@@ -1,14 +1,28 @@
-from distutils.util import execute
+"""
+Prompt sweep on Fakeddit: every prompt of --prompts with every feature setting, in one process.
+The model, the tokenizer, the dataset and the vision features are loaded once (src/runner/sweep.py),
+every cell is logged to MLflow as its own run. Arguments that are not sweep options go to src/main.py:
+
+    python experiments/run_experiments.py \
+        --settings none cooelf_detr cooelf_detr:data/fakeddit/partial/rationales/rationales.json \
+        --eval_bs 8 --num_workers 4
+"""
+
+import argparse
 import json
-import subprocess
+
+from dotenv import load_dotenv
+
+from src.args_parser import parse_args
+from src.runner.sweep import FakedditSweep, get_sweep_grid
 
 PROMPT_PATH = "experiments/resources/prompts.json"
-PYTHON_FILE_PATH = "src\main.py"
-EXPERIMENT_NAME = "mm-cot input fine-tuning" 
+EXPERIMENT_NAME = "mm-cot input fine-tuning"
 DATA_RANGE = ",500"
+RATIONALES_PATH = "data/fakeddit/partial/rationales/rationales.json"
 
-with open(PROMPT_PATH, "r") as f:
-    prompts = json.loads(f.read())["prompts"]
+# no image, image, image + rationale
+SETTINGS = ["none", "cooelf_detr", f"cooelf_detr:{RATIONALES_PATH}"]
 
 args = [
     "--user_msg",
@@ -27,15 +41,25 @@ args = [
     "--data_range",
     DATA_RANGE,
     "--experiment_name",
-    EXPERIMENT_NAME
+    EXPERIMENT_NAME,
+    "--prediction_cache"
 ]
 
-image_run = ["--img_type", "cooelf_detr"]
-image_rationale_run = image_run + ["--test_le", "data/fakeddit/partial/rationales/rationales.json"]
+if __name__ == '__main__':
+
+    load_dotenv(override=True)
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--prompts', type=str, default=PROMPT_PATH, help='json file with a "prompts" list')
+    parser.add_argument('--settings', type=str, nargs='+', default=SETTINGS,
+                        help='feature settings: none, <img_type> or <img_type>:<rationales file>')
+    sweep_args, main_args = parser.parse_known_args()
+
+    with open(sweep_args.prompts, "r") as f:
+        prompts = json.loads(f.read())["prompts"]
+
+    cells = get_sweep_grid(prompts, sweep_args.settings)
+    results = FakedditSweep(parse_args(args + main_args)).run(cells)
 
-for prompt in prompts:
-    for run in ( [], image_run, image_rationale_run):
-        script_args = args + run
-        script_args += ["--prompt", prompt]
-        cmd = ["python", PYTHON_FILE_PATH] + script_args
-        subprocess.run(cmd)
\ No newline at end of file
+    for cell, result in zip(cells, results):
+        print(json.dumps({"prompt": cell.prompt, "setting": cell.name, "accuracy": result.get("accuracy")}))
@@ -2,7 +2,7 @@ import argparse
 from src.constants import PromptFormat, Task
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--output_dir', type=str, default='experiments')
     parser.add_argument('--model', type=str,
@@ -51,8 +51,29 @@ def parse_args():
     parser.add_argument('--experiment_name', type=str, default='Default', help='mlflow experiment name')
     parser.add_argument('--prompt', type=str, default="""Question: \n Context: \n <TEXT> Options: """, help='Model input prompt')
     parser.add_argument('--repetition_penalty', type=float, default=1.0, help='Repetition penalty')
+    parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnx'], help='generation backend of the evaluation')
+    parser.add_argument('--onnx_dir', type=str, default=None, help='folder of the exported ONNX graphs (one subfolder per checkpoint, exported if missing), defaults to <save_dir>/onnx')
+    parser.add_argument('--no_dedup', action='store_true', help='generate every test sample, also the ones whose input (and image features) duplicate another sample')
+    parser.add_argument('--prediction_cache', action='store_true', help='reuse the predictions of inputs already evaluated with the same checkpoint and decoding settings (data/cache/predictions)')
+    parser.add_argument('--prediction_cache_mb', type=int, default=256, help='size of the prediction cache, least recently used predictions are evicted')
+    parser.add_argument('--compile', action='store_true', help='TorchScript inference with static shapes (length buckets, preallocated decoder cache), graphs cached on disk')
+    parser.add_argument('--quantize', action='store_true', help='CPU inference with a dynamically quantized int8 model, cached on disk')
+    parser.add_argument('--num_workers', type=int, default=1, help='evaluation processes on CPU, each one gets a contiguous shard of the test set')
+    parser.add_argument('--threads_per_worker', type=int, default=None, help='torch threads of every evaluation process, defaults to cores / num_workers')
+    parser.add_argument('--continuous_batching', action='store_true', help='swap finished rows for new samples during evaluation, keeps eval_bs rows in flight')
+    parser.add_argument('--no_stop_at_answer', action='store_true', help='keep generating after the answer pattern was emitted')
+    parser.add_argument('--score_options', action='store_true', help='answer by scoring every option instead of generating (answer stage only)')
+    parser.add_argument('--rationale_model', type=str, default=None, help='rationale (QCM-LE) checkpoint of the PIPELINE task')
+    parser.add_argument('--rationale_output_len', type=int, default=512, help='rationale length of the PIPELINE task')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='inference server host')
+    parser.add_argument('--port', type=int, default=8000, help='inference server port')
+    parser.add_argument('--max_batch_size', type=int, default=8, help='inference server micro-batch size')
+    parser.add_argument('--max_wait_ms', type=float, default=10.0, help='inference server wait for a micro-batch to fill up')
+    parser.add_argument('--sample', type=str, default=None, help='JSON file with the sample to predict with --task INFER')
+    parser.add_argument('--bf16', action='store_true', help='generate under bfloat16 autocast on CPU')
+    parser.add_argument('--no_tokenization_cache', action='store_true', help='always re-tokenize the datasets instead of using the on-disk cache')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.evaluate_dir is not None:
         args.model = args.evaluate_dir
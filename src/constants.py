@@ -26,13 +26,22 @@ FAKEDDIT_VISION_FEATURES_FOLDER_PATH = os.path.join(FAKEDDIT_DATASET_PARTIAL_PAT
 
 FAKEDDIT_VISION_FEATURES_DETR_PATH = os.path.join(FAKEDDIT_VISION_FEATURES_FOLDER_PATH, "detr-resnet-101-dc5")
 FAKEDDIT_VISION_FEATURES_DETR_FULL_PATH = os.path.join(FAKEDDIT_VISION_FEATURES_DETR_PATH, "dataset.npy")
+FAKEDDIT_VISION_FEATURES_DETR_DENSE_PATH = os.path.join(FAKEDDIT_VISION_FEATURES_DETR_PATH, "dataset.features")
 
 FAKEDDIT_VISION_FEATURES_COOELF_DETR_PATH = os.path.join(FAKEDDIT_VISION_FEATURES_FOLDER_PATH, "cooelf_detr_resnet101_dc5")
 FAKEDDIT_VISION_FEATURES_COOELF_DETR_FULL_PATH = os.path.join(FAKEDDIT_VISION_FEATURES_COOELF_DETR_PATH, "dataset.npy")
+FAKEDDIT_VISION_FEATURES_COOELF_DETR_DENSE_PATH = os.path.join(FAKEDDIT_VISION_FEATURES_COOELF_DETR_PATH, "dataset.features")
 
 FAKEDDIT_VISION_FEATURES_VIT_PATH = os.path.join(FAKEDDIT_VISION_FEATURES_FOLDER_PATH, "vit-large-patch16-224-in21k")
 FAKEDDIT_VISION_FEATURES_CLIP = os.path.join(FAKEDDIT_VISION_FEATURES_FOLDER_PATH, "clip-vit-large-patch14-336")
 
+CACHE_PATH = os.path.join(DATA_PATH, "cache")
+TOKENIZATION_CACHE_PATH = os.path.join(CACHE_PATH, "tokenization")
+QUANTIZED_MODELS_CACHE_PATH = os.path.join(CACHE_PATH, "quantized_models")
+COMPILED_MODELS_CACHE_PATH = os.path.join(CACHE_PATH, "compiled_models")
+PREDICTIONS_CACHE_PATH = os.path.join(CACHE_PATH, "predictions")
+EMBEDDINGS_CACHE_PATH = os.path.join(CACHE_PATH, "embeddings")
+
 class PromptFormat(Enum):
     """
     Possible values for the prompt format
@@ -56,6 +65,7 @@ class Task(Enum):
     EVALUATE = "EVALUATE"
     TRAIN = "TRAIN"
     INFER = "INFER"
+    PIPELINE = "PIPELINE"
 
 
 class DatasetType(Enum):
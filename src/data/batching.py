@@ -0,0 +1,140 @@
+import hashlib
+from typing import Dict, Iterator, List, Sequence
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+GENERATION_KEYS = ("input_ids", "attention_mask", "image_ids")
+
+
+def get_sequence_lengths(dataset: Dataset) -> np.ndarray:
+    """ Number of real (non padding) tokens of every sample """
+
+    for attribute in ("source_masks", "attention_masks"):
+        masks = getattr(dataset, attribute, None)
+        if masks is not None:
+            return masks.sum(dim=1).cpu().numpy().astype(np.int64)
+
+    return np.array([int(item["attention_mask"].sum()) for item in dataset], dtype=np.int64)
+
+
+def get_input_digest(item: dict) -> str:
+    """ Digest of what generation sees of a sample: the input ids without padding and the image features """
+
+    sha = hashlib.sha256()
+    input_ids = item["input_ids"][item["attention_mask"].bool()]
+    sha.update(input_ids.cpu().numpy().astype(np.int64).tobytes())
+
+    image_ids = item.get("image_ids")
+    if image_ids is not None:
+        sha.update(b"image")
+        sha.update(image_ids.detach().to("cpu", torch.float32).numpy().tobytes())
+    return sha.hexdigest()
+
+
+def get_input_digests(dataset: Dataset, indices: Sequence[int] = None) -> Dict[int, str]:
+    indices = range(len(dataset)) if indices is None else indices
+    return {int(index): get_input_digest(dataset[index]) for index in indices}
+
+
+class IndexedDataset(Dataset):
+    """
+    Adds the position of every sample so predictions can be written back in order.
+    With indices only those samples are exposed, "index" stays their position in the dataset.
+    """
+
+    def __init__(self, dataset: Dataset, indices: Sequence[int] = None):
+        self.dataset = dataset
+        self.indices = list(range(len(dataset))) if indices is None else [int(index) for index in indices]
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        dataset_index = self.indices[index]
+        return {**self.dataset[dataset_index], "index": dataset_index}
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler that groups samples of similar length.
+    Samples are sorted by length (longest first, ties kept in dataset order)
+    and cut into batches of batch_size.
+    """
+
+    def __init__(self, lengths: np.ndarray, batch_size: int):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        order = np.argsort(-self.lengths, kind="stable")
+        self.batches = [
+            order[start:start + batch_size].tolist()
+            for start in range(0, len(order), batch_size)
+        ]
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def padding_report(self, max_length: int) -> dict:
+        """ Share of padding tokens with static (max_length) and with dynamic padding """
+
+        return get_padding_report(
+            real_tokens=int(self.lengths.sum()),
+            static_tokens=len(self.lengths) * max_length,
+            dynamic_tokens=sum(len(batch) * int(self.lengths[batch].max()) for batch in self.batches))
+
+
+def get_padding_report(real_tokens: int, static_tokens: int, dynamic_tokens: int) -> dict:
+    return {
+        "real_tokens": real_tokens,
+        "static_tokens": static_tokens,
+        "dynamic_tokens": dynamic_tokens,
+        "static_padding_ratio": round(1 - real_tokens / max(static_tokens, 1), 4),
+        "dynamic_padding_ratio": round(1 - real_tokens / max(dynamic_tokens, 1), 4),
+    }
+
+
+def merge_padding_reports(reports: Sequence[dict]) -> dict:
+    """ Padding of the batches of several samplers (the shards of one evaluation) together """
+    return get_padding_report(**{
+        key: sum(report[key] for report in reports)
+        for key in ("real_tokens", "static_tokens", "dynamic_tokens")
+    })
+
+
+class EvaluationCollator:
+    """
+    Stacks only the tensors generation needs and trims input_ids and
+    attention_mask to the longest real sequence of the batch.
+    """
+
+    def __call__(self, features: List[dict]) -> dict:
+        batch = {
+            "index": torch.tensor([feature["index"] for feature in features])
+        }
+        for key in GENERATION_KEYS:
+            if key in features[0]:
+                batch[key] = torch.stack([feature[key] for feature in features])
+
+        max_length = int(batch["attention_mask"].sum(dim=1).max())
+        batch["input_ids"] = batch["input_ids"][:, :max_length]
+        batch["attention_mask"] = batch["attention_mask"][:, :max_length]
+
+        return batch
+
+
+def get_evaluation_dataloader(dataset: Dataset, batch_size: int, indices: Sequence[int] = None) -> DataLoader:
+    """ Length bucketed batches of the dataset, or of the samples at indices only """
+
+    lengths = get_sequence_lengths(dataset)
+    if indices is not None:
+        lengths = lengths[np.asarray(indices, dtype=np.int64)]
+    sampler = LengthBucketSampler(lengths, batch_size)
+    return DataLoader(
+        dataset=IndexedDataset(dataset, indices),
+        batch_sampler=sampler,
+        collate_fn=EvaluationCollator()
+    )
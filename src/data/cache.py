@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import shutil
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from src import constants
+
+MAX_CACHE_ENTRIES = 16
+MANIFEST_FILE = "manifest.json"
+
+_file_digests = {}
+
+
+def file_digest(path: str) -> str:
+    """ sha256 of a file, memoized on (path, size, mtime) """
+
+    stat = os.stat(path)
+    signature = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if signature not in _file_digests:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        _file_digests[signature] = sha.hexdigest()
+    return _file_digests[signature]
+
+
+def object_digest(obj) -> str:
+    serialized = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def tokenizer_signature(tokenizer) -> dict:
+    return {
+        "class": type(tokenizer).__name__,
+        "name_or_path": tokenizer.name_or_path,
+        "vocab_size": len(tokenizer),
+    }
+
+
+class TokenizationCache:
+    """
+    Content-addressed on-disk cache of tokenized tensors.
+    An entry is a folder named after the digest of the key fields and of the
+    source files, holding one .npy file per array (loaded with mmap) and a
+    manifest. Entries whose source files changed are evicted on open, and
+    only the MAX_CACHE_ENTRIES most recently used entries are kept.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        key_fields: dict,
+        sources: List[str] = None,
+        cache_dir: str = None
+    ):
+        self.sources = {
+            os.path.abspath(path): file_digest(path)
+            for path in sources or [] if path
+        }
+        self.key = object_digest({**key_fields, "sources": self.sources})
+        self.namespace_dir = os.path.join(
+            cache_dir or constants.TOKENIZATION_CACHE_PATH, namespace)
+        self.entry_dir = os.path.join(self.namespace_dir, self.key)
+
+        self._evict_stale()
+
+    def load(self) -> Optional[Tuple[Dict[str, np.ndarray], dict]]:
+        """ Returns the memory-mapped arrays and the metadata of the entry, None on miss """
+
+        manifest = self._read_manifest(self.entry_dir)
+        if manifest is None:
+            return None
+
+        try:
+            arrays = {
+                name: np.load(os.path.join(self.entry_dir, f"{name}.npy"), mmap_mode="c")
+                for name in manifest["arrays"]
+            }
+        except (OSError, ValueError):
+            shutil.rmtree(self.entry_dir, ignore_errors=True)
+            return None
+
+        os.utime(os.path.join(self.entry_dir, MANIFEST_FILE))
+        return arrays, manifest["meta"]
+
+    def save(self, arrays: Dict[str, np.ndarray], meta: dict = None) -> None:
+        os.makedirs(self.namespace_dir, exist_ok=True)
+        tmp_dir = f"{self.entry_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(array))
+
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as f:
+            json.dump({
+                "arrays": list(arrays),
+                "sources": self.sources,
+                "meta": meta or {}
+            }, f)
+
+        try:
+            os.rename(tmp_dir, self.entry_dir)
+        except OSError:
+            # another process wrote the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self._evict_least_recently_used()
+
+    def _read_manifest(self, entry_dir: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(entry_dir, MANIFEST_FILE), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _is_stale(self, manifest: dict) -> bool:
+        for path, digest in manifest.get("sources", {}).items():
+            if not os.path.exists(path) or file_digest(path) != digest:
+                return True
+        return False
+
+    def _entries(self) -> List[str]:
+        if not os.path.isdir(self.namespace_dir):
+            return []
+        return [
+            os.path.join(self.namespace_dir, name)
+            for name in os.listdir(self.namespace_dir)
+            if ".tmp-" not in name
+        ]
+
+    def _evict_stale(self) -> None:
+        for entry_dir in self._entries():
+            manifest = self._read_manifest(entry_dir)
+            if manifest is None or self._is_stale(manifest):
+                print(f"[Cache]: Evicting stale entry {entry_dir}")
+                shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def _evict_least_recently_used(self) -> None:
+        def last_used(entry_dir):
+            try:
+                return os.path.getmtime(os.path.join(entry_dir, MANIFEST_FILE))
+            except OSError:
+                return 0
+
+        entries = sorted(self._entries(), key=last_used, reverse=True)
+        for entry_dir in entries[MAX_CACHE_ENTRIES:]:
+            shutil.rmtree(entry_dir, ignore_errors=True)
@@ -0,0 +1,36 @@
+import json
+from typing import List, Optional
+
+import pandas as pd
+
+from src import constants
+from src.data.vision_features.dense_features import (DenseVisionFeatures,
+                                                     open_dense_features)
+
+# img_type -> (dense feature file, extractor model)
+VISION_FEATURES = {
+    "facebook_detr": (constants.FAKEDDIT_VISION_FEATURES_DETR_DENSE_PATH, "facebook/detr-resnet-101-dc5"),
+    "cooelf_detr": (constants.FAKEDDIT_VISION_FEATURES_COOELF_DETR_DENSE_PATH, "cooelf/detr_resnet101_dc5"),
+}
+
+
+def load_dataframe() -> pd.DataFrame:
+    return pd.read_csv(constants.FAKEDDIT_DATASET_PATH)
+
+
+def load_vision_features(img_type: Optional[str]) -> Optional[DenseVisionFeatures]:
+    """ Features of the whole dataset for img_type, None for text only runs or unknown types """
+
+    if img_type not in VISION_FEATURES:
+        return None
+    path, model_name = VISION_FEATURES[img_type]
+    return open_dense_features(path, model_name=model_name)
+
+
+def load_rationales(path: Optional[str]) -> Optional[List[str]]:
+    """ Rationales generated by a QCM-LE evaluation (its predictions file), None without path """
+
+    if not path:
+        return None
+    with open(path, "r") as f:
+        return json.loads(f.read())["predictions"]
@@ -1,21 +1,39 @@
 
 from typing import List, Tuple
 
-import numpy as np
 import pandas as pd
 import torch
 from torch import Tensor
 from torch.utils.data import Dataset
 from transformers import T5Tokenizer
 
+from src.data.cache import (TokenizationCache, object_digest,
+                            tokenizer_signature)
 from src.data.fakeddit.labels import (LabelsTypes, convert_int_to_label,
                                       get_label_column, get_label_text,
                                       get_options_text)
+from src.data.tokenization import batch_tokenize, normalize_text
+from src.data.vision_features.dense_features import DenseVisionFeatures
 
 DATASET_PATH = 'data/fakeddit/partial/dataset.csv'
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
+def get_question_text(
+    prompt: str,
+    title: str,
+    rationale: str = "",
+    labels_type: LabelsTypes = LabelsTypes.TWO_WAY
+) -> str:
+    options_text = get_options_text(labels_type)
+
+    question_text = prompt.replace("<TEXT>", title)
+    question_text = question_text.replace("<OPTIONS>", options_text)
+    question_text = "\n".join([question_text, rationale])
+
+    return question_text
+
+
 class FakedditDataset(Dataset):
 
     def __init__(
@@ -23,12 +41,14 @@ class FakedditDataset(Dataset):
         dataframe: pd.DataFrame,
         tokenizer: T5Tokenizer,
         prompt: str = "",
-        vision_features: np.ndarray = None,
+        vision_features: DenseVisionFeatures = None,
         rationales: List[str] = None,
         labels_type: LabelsTypes = LabelsTypes.TWO_WAY,
         source_len: int = 512,
         target_len: int = 512,
-        image_shape = (100,256)
+        image_shape = (100,256),
+        use_cache: bool = True,
+        dataset_path: str = None
     ) -> None:
 
         self.labels_type = labels_type
@@ -39,40 +59,66 @@ class FakedditDataset(Dataset):
         self.vision_features = vision_features
         self.rationales = rationales
         self.image_shape = image_shape
-
-        self.input_ids = torch.tensor([], device=device)
-        self.attention_masks = torch.tensor([], device=device)
-        self.labels = torch.tensor([], device=device)
+        self.use_cache = use_cache
+        self.dataset_path = dataset_path
 
         self.image_ids = None
-        if self.vision_features is not None:
-            self.image_ids = torch.tensor([], device=device)
-
         self.prompt = prompt
         self._build_dataset()
 
     def _build_dataset(self) -> None:
-        
-        for index, row in enumerate(self.dataframe.to_dict(orient="records")):
-            _rationale = ''
-            if self.rationales:
-                _rationale = self.rationales[index]
-
-            _input_ids, _attention_mask = self.get_input_ids(
-                row["clean_title"], _rationale)
-
-            self.input_ids = torch.cat(
-                (self.input_ids, _input_ids.unsqueeze(0)), 0)
-            self.attention_masks = torch.cat(
-                (self.attention_masks, _attention_mask.unsqueeze(0)), 0)
 
-            self.labels = torch.cat((self.labels, torch.tensor([self.get_label(index)], device=device)), 0)
+        titles = self.dataframe["clean_title"].astype(str).tolist()
+        rationales = self.rationales if self.rationales else [''] * len(titles)
+        if len(rationales) != len(titles):
+            raise ValueError(
+                f"Got {len(rationales)} rationales for {len(titles)} samples, the rationales must cover the data range")
+
+        cache = None
+        if self.use_cache:
+            cache = TokenizationCache(
+                namespace="fakeddit",
+                key_fields={
+                    "tokenizer": tokenizer_signature(self.tokenizer),
+                    "titles": object_digest(titles),
+                    "rationales": object_digest(rationales),
+                    "prompt": self.prompt,
+                    "labels_type": self.labels_type.value,
+                    "source_len": self.source_len,
+                },
+                sources=[self.dataset_path])
+
+        cached = cache.load() if cache is not None else None
+        if cached is not None:
+            arrays, _ = cached
+            input_ids = torch.from_numpy(arrays["input_ids"])
+            attention_masks = torch.from_numpy(arrays["attention_masks"])
+        else:
+            texts = [
+                self._get_question_text(title, rationale)
+                for title, rationale in zip(titles, rationales)
+            ]
+            input_ids, attention_masks = batch_tokenize(
+                self.tokenizer, texts, self.source_len)
+            if cache is not None:
+                cache.save({
+                    "input_ids": input_ids.numpy(),
+                    "attention_masks": attention_masks.numpy(),
+                })
+
+        self.input_ids = input_ids.to(device)
+        self.attention_masks = attention_masks.to(device)
 
+        label_column = get_label_column(self.labels_type)
+        self.labels = torch.tensor(
+            self.dataframe[label_column].astype(int).values, device=device)
+        self.plain_targets = [
+            get_label_text(convert_int_to_label(label)) for label in self.labels.tolist()
+        ]
 
-            if self.vision_features is not None:
-                _image_ids = self.get_image_ids(index)
-                self.image_ids = torch.cat(
-                    (self.image_ids, _image_ids.unsqueeze(0)), 0)
+        if self.vision_features is not None:
+            # zero-copy float16 view, rows are converted when an item is read
+            self.image_ids = self.vision_features.as_tensor()
 
     def get_input_ids(self, title: str, rationale: str) -> Tuple[Tensor, Tensor]:
 
@@ -85,35 +131,21 @@ class FakedditDataset(Dataset):
         return input_ids, attention_mask
 
     def _get_question_text(self, title: str, rationale: str) -> str:
-        options_text = get_options_text(self.labels_type)
-
-        question_text = self.prompt.replace("<TEXT>", title)
-        question_text = question_text.replace("<OPTIONS>", options_text)
-        question_text = "\n".join([question_text, rationale])
-
-        return question_text
+        return get_question_text(self.prompt, title, rationale, self.labels_type)
 
     def get_image_ids(self, vision_feature_index: int) -> Tensor:
-
-        image_ids = self.vision_features[vision_feature_index]
-        if not len(image_ids):
-            image_ids = np.zeros(self.image_shape)
-        else:
-            # TODO: remove on the original data
-            image_ids = image_ids[0, :, :]
-
-        return torch.tensor(image_ids).squeeze().to(device)
+        """ Missing or corrupt images are stored as zeros in the dense features """
+        return self.image_ids[vision_feature_index].to(device=device, dtype=torch.float)
 
     def get_label(self, index: str) -> str:
-        label_column = get_label_column(self.labels_type)
-        return int(self.dataframe.iloc[index][label_column])
+        return int(self.labels[index])
 
     def process_data(
             self,
             text,
             max_length
     ):
-        text = " ".join(str(text).split())
+        text = normalize_text(text)
         return self.tokenizer.batch_encode_plus(
             [text],
             max_length=max_length,
@@ -133,13 +165,13 @@ class FakedditDataset(Dataset):
             "input_ids": self.input_ids[index].to(torch.long),
             "attention_mask": self.attention_masks[index].to(torch.long),
             "labels":  self.get_label(index),
-            "plain_labels": get_label_text(convert_int_to_label(self.get_label(index)))
+            "plain_labels": self.plain_targets[index]
         }
 
         if self.image_ids is not None:
             item = {
                 **item,
-                "image_ids": self.image_ids[index].to(torch.float)
+                "image_ids": self.get_image_ids(index)
                 # "image_ids": torch.zeros(IMG_SHAPE).to(torch.float) FOR EXCLUDE VISION FEATURES
             }
 
@@ -1,4 +1,5 @@
 from enum import Enum
+from typing import List
 
 # These have been taken by a comment https://github.com/entitize/Fakeddit/issues/14
 # Check if it is truthful
@@ -39,6 +40,16 @@ def get_options_text(labels_type: LabelsTypes) -> str:
         return "(A) True (B) Satire (C) False connection (D) Imposter content (E) Manipulated content (F) Misleading content"
 
 
+def get_options(labels_type: LabelsTypes) -> List[str]:
+    """ Option letters of get_options_text """
+    if labels_type == LabelsTypes.TWO_WAY:
+        return ["A", "B"]
+    if labels_type == LabelsTypes.THREE_WAY:
+        return ["A", "B", "C"]
+    if labels_type == LabelsTypes.SIX_WAY:
+        return ["A", "B", "C", "D", "E", "F"]
+
+
 def get_label_column(labels_type: LabelsTypes) -> str:
     if labels_type == LabelsTypes.TWO_WAY:
         return "2_way_label"
@@ -1,12 +1,12 @@
 import json
 import os
 
-import numpy as np
 from zipfile import ZipFile
 from src import constants
+from src.data.vision_features.feature_store import VisionFeatureStore
 
 img_shape = {
-    "resnet": (512, 2048),
+    "resnet": (1, 2048),
     "clip": (49, 2048),
     "detr": (100, 256),
 }
@@ -23,16 +23,16 @@ def load_data(args):
 
     # check
     if args.img_type == "resnet":
-        image_features = np.load(constants.SCIENCEQA_RESNET)
-        image_features = np.expand_dims(image_features, axis=1)
-        image_features = image_features.repeat(512, axis=1)
+        # pooled vectors are fused as one patch instead of 512 identical copies
+        image_features = VisionFeatureStore(
+            constants.SCIENCEQA_RESNET, shape=img_shape["resnet"])
     elif args.img_type == "clip":
-        image_features = np.load(constants.SCIENCEQA_CLIP)
+        image_features = VisionFeatureStore(constants.SCIENCEQA_CLIP)
     elif args.img_type == "cooelf_detr":
-        image_features = np.load(constants.SCIENCEQA_DETR)
+        image_features = VisionFeatureStore(constants.SCIENCEQA_DETR)
     else:
-        image_features = np.load(constants.SCIENCEQA_DETR)
-    print("img_features size: ", image_features.shape)
+        image_features = VisionFeatureStore(constants.SCIENCEQA_DETR)
+    print("img_features size: ", (len(image_features), *image_features.shape))
 
     qids = get_qids(args, captions, pid_splits, problems)
     return problems, qids, name_maps, image_features
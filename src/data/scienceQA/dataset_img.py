@@ -1,11 +1,11 @@
-import numpy as np
 import torch
 
 from src.data.scienceQA.dataset_std import ScienceQADatasetStd
+from src.data.vision_features.feature_store import MISSING_ROW, VisionFeatureStore
 
 # TODO img_shape should not be here!
 img_shape = {
-    "resnet": (512, 2048),
+    "resnet": (1, 2048),
     "clip": (49, 2048),
     "facebook_detr": (100, 256),
     "cooelf_detr": (100, 256)
@@ -30,7 +30,7 @@ class ScienceQADatasetImg(ScienceQADatasetStd):
             source_len,
             target_len,
             args,
-            image_features=None,
+            image_features: VisionFeatureStore = None,
             test_le=None,
             name_maps=None,
     ):
@@ -56,23 +56,16 @@ class ScienceQADatasetImg(ScienceQADatasetStd):
             test_le
         )
 
-        self.image_ids = torch.tensor([]).to(device)
-        for qid in self.data:
-
-            if str(qid) in name_maps:
-                i_vectors = image_features[int(name_maps[str(qid)])]
-            else:
-                shape = img_shape[args.img_type]
-                i_vectors = np.zeros(shape)
-            i_vectors = torch.tensor(i_vectors).squeeze().to(device)
-
-            self.image_ids = torch.cat(
-                (self.image_ids, i_vectors.unsqueeze(0)), 0)
+        rows = [
+            int(name_maps[str(qid)]) if str(qid) in name_maps else MISSING_ROW
+            for qid in self.data
+        ]
+        self.image_ids = image_features.rows(rows)
 
     def __getitem__(self, index):
         """return the input ids, attention masks and target ids"""
 
         return {
             **super().__getitem__(index),
-            "image_ids": self.image_ids[index].to(torch.float),
+            "image_ids": self.image_ids[index].to(device=device, dtype=torch.float),
         }
@@ -1,8 +1,12 @@
 import json
+import os
 
 import torch
 from torch.utils.data import Dataset
 
+from src import constants
+from src.data.cache import TokenizationCache, tokenizer_signature
+from src.data.tokenization import batch_tokenize, normalize_text
 from src.models.prompt import build_train_pair
 
 
@@ -41,45 +45,79 @@ class ScienceQADatasetStd(Dataset):
 
         self.tokenizer = tokenizer
         self.data = {qid: problems[qid] for qid in qids}
+        self.qids = list(self.data)
         self.source_len = source_len
         self.summ_len = target_len
 
-        self.source_ids = torch.tensor([]).to(device)
-        self.source_masks = torch.tensor([]).to(device)
-        self.target_ids = torch.tensor([]).to(device)
-        self.plain_targets = []
+        cache = None
+        if not args.no_tokenization_cache:
+            cache = TokenizationCache(
+                namespace="scienceqa",
+                key_fields={
+                    "tokenizer": tokenizer_signature(tokenizer),
+                    "qids": list(qids),
+                    "prompt_format": args.prompt_format,
+                    "options": args.options,
+                    "use_caption": args.use_caption,
+                    "source_len": source_len,
+                    "target_len": target_len,
+                },
+                sources=[constants.SCIENCEQA_PROBLEMS_PATH, test_le, self._caption_source(args)])
+
+        cached = cache.load() if cache is not None else None
+        if cached is not None:
+            arrays, meta = cached
+            source_ids = torch.from_numpy(arrays["source_ids"])
+            source_masks = torch.from_numpy(arrays["source_masks"])
+            target_ids = torch.from_numpy(arrays["target_ids"])
+            self.plain_targets = meta["plain_targets"]
+        else:
+            source_ids, source_masks, target_ids = self._build(
+                problems, args, test_le)
+            if cache is not None:
+                cache.save({
+                    "source_ids": source_ids.numpy(),
+                    "source_masks": source_masks.numpy(),
+                    "target_ids": target_ids.numpy(),
+                }, {"plain_targets": self.plain_targets})
+
+        self.source_ids = source_ids.to(device)
+        self.source_masks = source_masks.to(device)
+        self.target_ids = target_ids.to(device)
+
+    @staticmethod
+    def _caption_source(args):
+        """ The prompts embed the captions with --use_caption, the cache entry depends on their file """
+        if args.use_caption and args.caption_file and os.path.exists(args.caption_file):
+            return args.caption_file
+        return None
+
+    def _build(self, problems, args, test_le):
+        """ Render every prompt and tokenize sources and targets in batches """
 
         if test_le is not None:
             test_le_data = json.load(open(test_le))["preds"]
         else:
             test_le_data = None
 
-        idx = 0
-        for qid in self.data:
-            if test_le_data is not None:
-                curr_le_data = test_le_data[idx]
-                idx += 1
-            else:
-                curr_le_data = None
+        prompts = []
+        self.plain_targets = []
+        for idx, qid in enumerate(self.data):
+            curr_le_data = test_le_data[idx] if test_le_data is not None else None
             prompt, target = build_train_pair(
                 problems, qid, args, curr_le_data)
+            prompts.append(prompt)
+            self.plain_targets.append(target)
 
-            # SOURCE
-            source = self.process_data(prompt, self.source_len)
-            source_id = source["input_ids"].squeeze().to(device)
-            source_mask = source["attention_mask"].squeeze().to(device)
+        # SOURCE
+        source_ids, source_masks = batch_tokenize(
+            self.tokenizer, prompts, self.source_len)
 
-            # TARGET
-            self.plain_targets.append(target)
-            target = self.process_data(target, self.summ_len)
-            target = target["input_ids"].squeeze().to(device)
+        # TARGET
+        target_ids, _ = batch_tokenize(
+            self.tokenizer, self.plain_targets, self.summ_len)
 
-            self.source_ids = torch.cat(
-                (self.source_ids, source_id.unsqueeze(0)), 0)
-            self.source_masks = torch.cat(
-                (self.source_masks, source_mask.unsqueeze(0)), 0)
-            self.target_ids = torch.cat(
-                (self.target_ids, target.unsqueeze(0)), 0)
+        return source_ids, source_masks, target_ids
 
     def __len__(self):
         """returns the length of dataframe"""
@@ -100,7 +138,7 @@ class ScienceQADatasetStd(Dataset):
             text,
             max_length
     ):
-        text = " ".join(str(text).split())
+        text = normalize_text(text)
         return self.tokenizer.batch_encode_plus(
             [text],
             max_length=max_length,
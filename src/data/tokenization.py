@@ -0,0 +1,42 @@
+from typing import List, Tuple
+
+import torch
+from torch import Tensor
+
+TOKENIZATION_BATCH_SIZE = 1024
+
+
+def normalize_text(text) -> str:
+    return " ".join(str(text).split())
+
+
+def batch_tokenize(
+    tokenizer,
+    texts: List[str],
+    max_length: int,
+    batch_size: int = TOKENIZATION_BATCH_SIZE
+) -> Tuple[Tensor, Tensor]:
+    """
+    Tokenize a list of texts in large batches and write the result into
+    preallocated (len(texts), max_length) tensors.
+    Returns the input ids and the attention masks.
+    """
+
+    input_ids = torch.full(
+        (len(texts), max_length), tokenizer.pad_token_id, dtype=torch.long)
+    attention_masks = torch.zeros((len(texts), max_length), dtype=torch.long)
+
+    for start in range(0, len(texts), batch_size):
+        chunk = [normalize_text(text) for text in texts[start:start + batch_size]]
+        encoded = tokenizer(
+            chunk,
+            max_length=max_length,
+            truncation=True,
+            padding="max_length",
+            return_tensors="pt",
+        )
+        end = start + len(chunk)
+        input_ids[start:end] = encoded["input_ids"]
+        attention_masks[start:end] = encoded["attention_mask"]
+
+    return input_ids, attention_masks
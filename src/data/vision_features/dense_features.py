@@ -0,0 +1,175 @@
+import json
+import os
+import struct
+from typing import Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from torch import Tensor
+
+MAGIC = b"MMCOTVF1"
+ALIGNMENT = 64
+DENSE_FEATURES_EXTENSION = ".features"
+
+# File layout, every section starts on an ALIGNMENT byte boundary:
+# MAGIC | uint32 header length | JSON header | validity bitmap (np.packbits) | float16 rows
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def get_dense_path(npy_path: str) -> str:
+    return os.path.splitext(npy_path)[0] + DENSE_FEATURES_EXTENSION
+
+
+def _as_row(vision_feature, row_shape: Tuple[int, ...]) -> Optional[np.ndarray]:
+    """ Returns the feature reshaped to row_shape, None if it is missing or corrupt """
+
+    if vision_feature is None:
+        return None
+    vision_feature = np.asarray(vision_feature)
+    if vision_feature.size == 0 or vision_feature.size != int(np.prod(row_shape)):
+        return None
+    return vision_feature.reshape(row_shape)
+
+
+def infer_row_shape(vision_features: Iterable) -> Tuple[int, ...]:
+    """ Shape of the first non empty feature, without the leading batch dimensions of size 1 """
+
+    for vision_feature in vision_features:
+        shape = np.shape(vision_feature)
+        if not shape or 0 in shape:
+            continue
+        while len(shape) > 2 and shape[0] == 1:
+            shape = shape[1:]
+        return tuple(shape)
+    raise ValueError("No valid vision feature to infer the row shape from")
+
+
+def save_dense_features(
+    path: str,
+    vision_features: Sequence,
+    model_name: str = "",
+    row_shape: Tuple[int, ...] = None
+) -> None:
+    """
+    Writes the features as one contiguous float16 array.
+    Missing or corrupt features (empty arrays, wrong size) are stored as zeros and flagged invalid.
+    """
+
+    row_shape = tuple(row_shape) if row_shape else infer_row_shape(vision_features)
+    num_rows = len(vision_features)
+
+    rows = [_as_row(vision_feature, row_shape) for vision_feature in vision_features]
+    valid = np.array([row is not None for row in rows], dtype=bool)
+    bitmap = np.packbits(valid)
+
+    header = {
+        "model_name": model_name,
+        "shape": [num_rows, *row_shape],
+        "dtype": "float16",
+        "num_valid": int(valid.sum()),
+    }
+    header_size = len(MAGIC) + 4 + len(json.dumps({**header, "bitmap_offset": 0, "data_offset": 0})) + 32
+    header["bitmap_offset"] = _align(header_size)
+    header["data_offset"] = _align(header["bitmap_offset"] + len(bitmap))
+    header_bytes = json.dumps(header).encode("utf-8")
+
+    data_size = num_rows * int(np.prod(row_shape)) * np.dtype(np.float16).itemsize
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+        f.seek(header["bitmap_offset"])
+        f.write(bitmap.tobytes())
+        f.truncate(header["data_offset"] + data_size)
+
+    if not num_rows:
+        return
+
+    data = np.memmap(path, dtype=np.float16, mode="r+",
+                     offset=header["data_offset"], shape=(num_rows, *row_shape))
+    for index, row in enumerate(rows):
+        if row is not None:
+            data[index] = row
+    data.flush()
+    del data
+
+
+def convert_object_npy(npy_path: str, dense_path: str = None, model_name: str = "") -> str:
+    """ Converts a pickled object array (one array per image) to the dense format """
+
+    dense_path = dense_path or get_dense_path(npy_path)
+    vision_features = np.load(npy_path, allow_pickle=True)
+    save_dense_features(dense_path, list(vision_features), model_name=model_name)
+    return dense_path
+
+
+class DenseVisionFeatures:
+    """
+    Read-only, memory-mapped view over a dense feature file.
+    Indexing with an integer returns one row, slicing returns another view; neither copies.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a dense vision features file")
+            header_len, = struct.unpack("<I", f.read(4))
+            self.header = json.loads(f.read(header_len).decode("utf-8"))
+
+        self.model_name = self.header["model_name"]
+        num_rows, *row_shape = self.header["shape"]
+        self.row_shape = tuple(row_shape)
+
+        bitmap = np.memmap(path, dtype=np.uint8, mode="r", offset=self.header["bitmap_offset"],
+                           shape=((num_rows + 7) // 8,)) if num_rows else np.zeros(0, dtype=np.uint8)
+        self.valid = np.unpackbits(bitmap, count=num_rows).astype(bool)
+
+        # copy-on-write so that torch.from_numpy can share the buffer without a warning
+        self.features = np.memmap(path, dtype=np.float16, mode="c", offset=self.header["data_offset"],
+                                  shape=(num_rows, *row_shape)) if num_rows else np.zeros((0, *row_shape), dtype=np.float16)
+
+    @classmethod
+    def _view(cls, parent: "DenseVisionFeatures", index: slice) -> "DenseVisionFeatures":
+        view = cls.__new__(cls)
+        view.path = parent.path
+        view.header = parent.header
+        view.model_name = parent.model_name
+        view.row_shape = parent.row_shape
+        view.valid = parent.valid[index]
+        view.features = parent.features[index]
+        return view
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.features.shape
+
+    def __len__(self) -> int:
+        return len(self.features)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return DenseVisionFeatures._view(self, index)
+        return self.features[index]
+
+    def as_tensor(self) -> Tensor:
+        """ float16 tensor sharing the memory-mapped buffer """
+        return torch.from_numpy(self.features)
+
+
+def open_dense_features(path: str, model_name: str = "") -> DenseVisionFeatures:
+    """
+    Opens a dense feature file. If it does not exist yet but the pickled
+    .npy file next to it does, the .npy file is converted first.
+    """
+
+    if not os.path.exists(path):
+        npy_path = os.path.splitext(path)[0] + ".npy"
+        if not os.path.exists(npy_path):
+            raise FileNotFoundError(path)
+        print(f"[Data]: Converting {npy_path} to {path}")
+        convert_object_npy(npy_path, path, model_name=model_name)
+    return DenseVisionFeatures(path)
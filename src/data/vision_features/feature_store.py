@@ -0,0 +1,72 @@
+from typing import Sequence, Tuple, Union
+
+import numpy as np
+import torch
+from torch import Tensor
+
+MISSING_ROW = -1
+
+
+class VisionFeatureStore:
+    """
+    Vision features opened with np.load(mmap_mode='r').
+    Rows are only read from disk when they are gathered, so the resident
+    memory stays close to the size of the rows of one batch.
+    """
+
+    def __init__(self, path: str, shape: Tuple[int, ...] = None):
+        """
+        :param path: .npy file of shape (num_images, *feature_shape)
+        :param shape: shape of one feature row, defaults to the file row shape.
+            Pooled (num_images, dim) features are exposed as a single patch with shape=(1, dim)
+        """
+
+        self.path = path
+        self.features = np.load(path, mmap_mode="r")
+        self.shape = tuple(shape) if shape else tuple(self.features.shape[1:])
+
+    def __len__(self) -> int:
+        return len(self.features)
+
+    def gather(self, rows: Union[Sequence[int], np.ndarray]) -> Tensor:
+        """ Returns a float tensor (len(rows), *shape), rows equal to MISSING_ROW are zeros """
+
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        present = rows != MISSING_ROW
+
+        row_shape = self.features.shape[1:]
+        gathered = np.zeros((len(rows), *row_shape), dtype=np.float32)
+        if present.any():
+            # read each distinct row once and in file order
+            unique_rows, inverse = np.unique(rows[present], return_inverse=True)
+            gathered[present] = self.features[unique_rows][inverse]
+
+        return torch.from_numpy(gathered).reshape(len(rows), *self.shape)
+
+    def rows(self, rows: Union[Sequence[int], np.ndarray]) -> "FeatureRows":
+        return FeatureRows(self, rows)
+
+
+class FeatureRows:
+    """
+    Lazy view over a subset of the rows of a VisionFeatureStore, indexed like
+    the dense (len(rows), *shape) tensor it stands for.
+    """
+
+    def __init__(self, store: VisionFeatureStore, rows: Union[Sequence[int], np.ndarray]):
+        self.store = store
+        self.rows = np.asarray(rows, dtype=np.int64)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return (len(self.rows), *self.store.shape)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, index) -> Tensor:
+        if isinstance(index, Tensor):
+            index = index.tolist()
+        if np.isscalar(index):
+            return self.store.gather([self.rows[index]])[0]
+        return self.store.gather(self.rows[index])
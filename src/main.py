@@ -1,19 +1,20 @@
+import copy
 import json
 import os
 
-import numpy as np
-import pandas as pd
 from rich import box
 from rich.table import Column, Table
-from transformers import T5Tokenizer
+from transformers import T5TokenizerFast
 
 from src import constants
 from src.args_parser import parse_args
+from src.data.fakeddit.data import (load_dataframe, load_rationales,
+                                    load_vision_features)
 from src.data.fakeddit.dataset import FakedditDataset
 from src.data.scienceQA.data import load_data
 from src.runner.chain_of_thought import ChainOfThought
 from src.models.t5_multimodal_generation.training_params import (
-    get_t5_model, get_training_data)
+    get_t5_model, get_test_data, get_training_data)
 from src.models.t5_multimodal_generation.utils import get_backup_dir
 from dotenv import load_dotenv
 
@@ -21,38 +22,37 @@ from src.utils import parse_range
 
 args = parse_args()
 
-def get_fakeddit_cot():
-
-    data_range_start, data_rage_end = parse_range(args.data_range)
-    tokenizer = T5Tokenizer.from_pretrained(
-        pretrained_model_name_or_path=args.model)
-    model = get_t5_model(args, tokenizer, get_backup_dir(args))
+def get_fakeddit_test_set(run_args, tokenizer) -> FakedditDataset:
 
-    dataframe = pd.read_csv(constants.FAKEDDIT_DATASET_PATH)
+    data_range_start, data_rage_end = parse_range(run_args.data_range)
+    dataframe = load_dataframe()
 
     rationales = None
-    if args.test_le:
-        with open(args.test_le, "r") as f:
-            rationale_df = json.loads(f.read())
-        rationales = rationale_df['predictions'][data_range_start:data_rage_end]
-
-    vision_features = None
-
-    if args.img_type == "detr_facebook":
-        vision_features = np.load(
-            constants.FAKEDDIT_VISION_FEATURES_DETR_FULL_PATH, allow_pickle=True)[data_range_start:data_rage_end]
+    if run_args.test_le:
+        rationales = load_rationales(run_args.test_le)[data_range_start:data_rage_end]
 
-    elif args.img_type == "cooelf_detr":
-        vision_features = np.load(
-            constants.FAKEDDIT_VISION_FEATURES_COOELF_DETR_FULL_PATH, allow_pickle=True)[data_range_start:data_rage_end]
+    vision_features = load_vision_features(run_args.img_type)
+    if vision_features is not None:
+        vision_features = vision_features[data_range_start:data_rage_end]
 
-    test_set = FakedditDataset(
+    return FakedditDataset(
         dataframe=dataframe[data_range_start:data_rage_end],
         tokenizer=tokenizer,
         vision_features=vision_features,
         rationales=rationales,
-        prompt=args.prompt
+        prompt=run_args.prompt,
+        use_cache=not run_args.no_tokenization_cache,
+        dataset_path=constants.FAKEDDIT_DATASET_PATH
     )
+
+
+def get_fakeddit_cot():
+
+    tokenizer = T5TokenizerFast.from_pretrained(
+        pretrained_model_name_or_path=args.model)
+    model = get_t5_model(args, tokenizer, get_backup_dir(args))
+
+    test_set = get_fakeddit_test_set(args, tokenizer)
     chain_of_thought = ChainOfThought(args) \
         .set_tokenizer(tokenizer) \
         .set_eval_set(test_set) \
@@ -62,21 +62,27 @@ def get_fakeddit_cot():
     return chain_of_thought
 
 
-def get_science_qa_cot():
-    tokenizer = T5Tokenizer.from_pretrained(
-        pretrained_model_name_or_path=args.model)
-    model = get_t5_model(args, tokenizer, get_backup_dir(args))
-
-    problems, qids, name_maps, image_features = load_data(args)
-    dataframe = {
+def get_science_qa_dataframe(run_args) -> dict:
+    problems, qids, name_maps, image_features = load_data(run_args)
+    return {
         'problems': problems,
         'qids': qids,
         'name_maps': name_maps,
         'image_features': image_features
     }
 
+
+def get_science_qa_test_set(run_args, tokenizer):
+    return get_test_data(run_args, get_science_qa_dataframe(run_args), tokenizer)
+
+
+def get_science_qa_cot():
+    tokenizer = T5TokenizerFast.from_pretrained(
+        pretrained_model_name_or_path=args.model)
+    model = get_t5_model(args, tokenizer, get_backup_dir(args))
+
     train_set, eval_set, test_set = get_training_data(
-        args, dataframe, tokenizer)
+        args, get_science_qa_dataframe(args), tokenizer)
 
     chain_of_thought = ChainOfThought(args) \
         .set_tokenizer(tokenizer) \
@@ -88,6 +94,58 @@ def get_science_qa_cot():
     return chain_of_thought
 
 
+def get_inference_cot():
+    """ Only the tokenizer and the model, samples are rendered on request """
+    tokenizer = T5TokenizerFast.from_pretrained(
+        pretrained_model_name_or_path=args.model)
+    model = get_t5_model(args, tokenizer, get_backup_dir(args))
+
+    return ChainOfThought(args) \
+        .set_tokenizer(tokenizer) \
+        .set_model(model)
+
+
+def get_pipeline_cot():
+    """
+    Rationale (--rationale_model) and answer (--model) checkpoints in one process.
+    Only the test split is built, with the rationale stage prompts (QCM-LE); its
+    image rows are passed on to the answer stage batch by batch.
+    """
+    if not args.rationale_model:
+        raise ValueError("--rationale_model is required to run the PIPELINE task")
+
+    rationale_args = copy.copy(args)
+    rationale_args.prompt_format = constants.PromptFormat.QUESTION_CONTEXT_OPTIONS_LECTURE_SOLUTION.value
+    rationale_args.model = args.rationale_model
+    rationale_args.evaluate_dir = args.rationale_model
+
+    tokenizer = T5TokenizerFast.from_pretrained(
+        pretrained_model_name_or_path=args.model)
+    model = get_t5_model(args, tokenizer, get_backup_dir(args))
+    rationale_model = get_t5_model(
+        rationale_args, tokenizer, get_backup_dir(rationale_args))
+
+    test_set = test_set_map.get(args.dataset)(rationale_args, tokenizer)
+
+    return ChainOfThought(args) \
+        .set_tokenizer(tokenizer) \
+        .set_eval_set(test_set) \
+        .set_test_set(test_set) \
+        .set_model(model) \
+        .set_rationale_model(rationale_model)
+
+
+cot_map = {
+    constants.DatasetType.FAKEDDIT.value: get_fakeddit_cot,
+    constants.DatasetType.SCIENCEQA.value: get_science_qa_cot,
+}
+
+test_set_map = {
+    constants.DatasetType.FAKEDDIT.value: get_fakeddit_test_set,
+    constants.DatasetType.SCIENCEQA.value: get_science_qa_test_set,
+}
+
+
 if __name__ == '__main__':
 
     # import nltk
@@ -112,9 +170,10 @@ if __name__ == '__main__':
     if not os.path.exists(args.output_dir):
         os.mkdir(args.output_dir)
 
-    cot_map = {
-        constants.DatasetType.FAKEDDIT.value: get_fakeddit_cot,
-        constants.DatasetType.SCIENCEQA.value: get_science_qa_cot,
-    }
-    cot = cot_map.get(args.dataset)()
+    if args.task == constants.Task.INFER.value:
+        cot = get_inference_cot()
+    elif args.task == constants.Task.PIPELINE.value:
+        cot = get_pipeline_cot()
+    else:
+        cot = cot_map.get(args.dataset)()
     cot.run()
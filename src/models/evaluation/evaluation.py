@@ -3,31 +3,82 @@ Adapted from https://github.com/lupantech/ScienceQA
 '''
 
 import json
+import os
 import warnings
+from functools import lru_cache
 
+import numpy as np
 import pandas as pd
+import torch
 from sentence_transformers import SentenceTransformer
 
+from src.data.cache import file_digest
 from src.models.evaluation.evaluation_metrics import caculate_bleu, caculate_rouge, caculate_similariry
 
 warnings.filterwarnings('ignore')
 
-
-def get_acc_with_contion(res_pd, key, values):
-    if isinstance(values, list):
-        total_pd = res_pd[res_pd[key].isin(values)]
-    else:
-        total_pd = res_pd[res_pd[key] == values]
-    correct_pd = total_pd[total_pd['true_false'] == True]
-    
-    #FIXME
-    acc = -1
-    try:
-        acc = "{:.2f}".format(len(correct_pd) / len(total_pd) * 100)
-    except:
-        pass
-
-    return acc
+SIMILARITY_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+GRADES_1_6 = ['grade1', 'grade2', 'grade3', 'grade4', 'grade5', 'grade6']
+GRADES_7_12 = ['grade7', 'grade8', 'grade9', 'grade10', 'grade11', 'grade12']
+
+
+@lru_cache(maxsize=4)
+def _load_test_attributes(data_file: str, digest: str) -> pd.DataFrame:
+    problems = json.load(open(data_file))
+    qids = [qid for qid, problem in problems.items() if problem['split'] == 'test']
+    has_text = np.array([bool(problems[qid]['hint']) for qid in qids])
+    has_image = np.array([bool(problems[qid]['image']) for qid in qids])
+
+    return pd.DataFrame({
+        'answer': [problems[qid]['answer'] for qid in qids],
+        'subject': pd.Categorical([problems[qid]['subject'] for qid in qids]),
+        'grade': pd.Categorical([problems[qid]['grade'] for qid in qids]),
+        'has_text': has_text,
+        'has_image': has_image,
+        'no_context': ~has_text & ~has_image,
+        'has_text_image': has_text & has_image,
+    }, index=pd.Index(qids, name='qid'))
+
+
+def get_test_attributes(data_file: str) -> pd.DataFrame:
+    """
+    Attributes of the test split questions (answer, subject, grade, context), indexed by qid.
+    Built once per version of the data file.
+    """
+    return _load_test_attributes(os.path.abspath(data_file), file_digest(data_file))
+
+
+def get_answer_accuracies(results: dict, data_file: str) -> dict:
+    """ Accuracy overall and per subject, context and grade group; -1 for empty groups """
+
+    attributes = get_test_attributes(data_file)
+    attributes = attributes.loc[attributes.index.intersection(list(results), sort=False)]
+    predictions = pd.Series(results).loc[attributes.index].astype(int)
+    correct = (attributes['answer'].astype(int) == predictions).to_numpy()
+
+    masks = pd.DataFrame({
+        'acc_natural': attributes['subject'] == 'natural science',
+        'acc_social': attributes['subject'] == 'social science',
+        'acc_language': attributes['subject'] == 'language science',
+        'acc_has_text': attributes['has_text'],
+        'acc_has_image': attributes['has_image'],
+        'acc_no_context': attributes['no_context'],
+        'acc_grade_1_6': attributes['grade'].isin(GRADES_1_6),
+        'acc_grade_7_12': attributes['grade'].isin(GRADES_7_12),
+    })
+
+    # correct answers and questions of every group in one pass over the mask matrix
+    totals = masks.to_numpy().sum(axis=0)
+    hits = correct.astype(np.int64) @ masks.to_numpy(dtype=np.int64)
+    accuracies = {
+        name: "{:.2f}".format(hit / total * 100) if total else -1
+        for name, hit, total in zip(masks.columns, hits, totals)
+    }
+    accuracies['acc_average'] = "{:.2f}".format(correct.sum() / len(results) * 100)
+    return accuracies
 
 
 def get_scores(result_data, rationale_data, results_reference, data_file):
@@ -37,32 +88,6 @@ def get_scores(result_data, rationale_data, results_reference, data_file):
     # assert num == 4241                        ???
     # print("number of questions:", num)
 
-    # read data file
-    sqa_data = json.load(open(data_file))
-
-    # construct pandas data
-    sqa_pd = pd.DataFrame(sqa_data).T
-    res_pd = sqa_pd[sqa_pd['split'] == 'test']  # test set
-
-    # update data
-    for index, row in res_pd[:len(result_data)].iterrows():
-
-        res_pd.loc[index, 'no_context'] = True if (
-            not row['hint'] and not row['image']) else False
-        res_pd.loc[index, 'has_text'] = True if row['hint'] else False
-        res_pd.loc[index, 'has_image'] = True if row['image'] else False
-        res_pd.loc[index, 'has_text_image'] = True if (
-            row['hint'] and row['image']) else False
-
-        label = row['answer']
-        pred = int(results[index])
-        res_pd.loc[index, 'pred'] = pred
-        res_pd.loc[index, 'true_false'] = (label == pred)
-
-    # accuracy scores
-    acc_average = len(res_pd[res_pd['true_false'] == True]) / num * 100
-    # assert result_file.split('_')[-1] == "{:.3f}.json".format(acc_average)
-
     # rationale quality
 
     # BLEU
@@ -73,33 +98,11 @@ def get_scores(result_data, rationale_data, results_reference, data_file):
     rouge = caculate_rouge(rationale_data, results_reference)
 
     # Similarity
-    model = SentenceTransformer(
-        'sentence-transformers/all-MiniLM-L6-v2').cuda()
-    similariry = caculate_similariry(rationale_data, results_reference, model)
+    model = SentenceTransformer(SIMILARITY_MODEL, device=device)
+    similariry = caculate_similariry(rationale_data, results_reference, model, model_name=SIMILARITY_MODEL)
 
     scores = {
-        "answer": {
-            'acc_natural':
-                get_acc_with_contion(res_pd, 'subject', 'natural science'),
-                'acc_social':
-                get_acc_with_contion(res_pd, 'subject', 'social science'),
-                'acc_language':
-                get_acc_with_contion(res_pd, 'subject', 'language science'),
-                'acc_has_text':
-                get_acc_with_contion(res_pd, 'has_text', True),
-                'acc_has_image':
-                get_acc_with_contion(res_pd, 'has_image', True),
-                'acc_no_context':
-                get_acc_with_contion(res_pd, 'no_context', True),
-                'acc_grade_1_6':
-                get_acc_with_contion(
-                    res_pd, 'grade', ['grade1', 'grade2', 'grade3', 'grade4', 'grade5', 'grade6']),
-                'acc_grade_7_12':
-                get_acc_with_contion(res_pd, 'grade', [
-                                     'grade7', 'grade8', 'grade9', 'grade10', 'grade11', 'grade12']),
-                'acc_average':
-                "{:.2f}".format(acc_average),
-        },
+        "answer": get_answer_accuracies(results, data_file),
         "rationale": {
             'bleu1': bleu1 * 100,
                 'bleu4': bleu4 * 100,
@@ -2,6 +2,8 @@
 Adapted from https://github.com/lupantech/ScienceQA
 '''
 
+import hashlib
+import os
 import re
 
 import numpy as np
@@ -10,6 +12,11 @@ from nltk.translate.bleu_score import sentence_bleu
 from rouge import Rouge
 from sentence_transformers import util
 
+from src import constants
+from src.data.cache import object_digest
+
+SIMILARITY_BATCH_SIZE = 128
+
 ########################
 # BLEU
 ########################
@@ -95,18 +102,60 @@ def similariry_score(str1, str2, model):
     return score
 
 
-def caculate_similariry(results, data, model):
-    scores = []
-    for qid, output in results.items():
-        prediction = output
-        target = data[qid]
-        target = target.strip()
+def _text_digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def encode_references(texts, model, model_name=None, batch_size=SIMILARITY_BATCH_SIZE):
+    """
+    Normalized embeddings of the reference rationales. With model_name they are cached
+    on disk (one file per model, one row per distinct text) and only new texts are encoded.
+    """
+
+    if model_name is None:
+        return model.encode(texts, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+
+    path = os.path.join(constants.EMBEDDINGS_CACHE_PATH, f"{object_digest(model_name)}.npz")
+    cached = {}
+    if os.path.exists(path):
+        with np.load(path) as stored:
+            cached = dict(zip(stored["keys"].tolist(), stored["embeddings"]))
+
+    digests = [_text_digest(text) for text in texts]
+    missing = list({digest: text for digest, text in zip(digests, texts) if digest not in cached}.items())
+    if missing:
+        embeddings = model.encode([text for _, text in missing], batch_size=batch_size,
+                                  convert_to_numpy=True, normalize_embeddings=True)
+        cached.update(zip([digest for digest, _ in missing], embeddings))
+
+        os.makedirs(constants.EMBEDDINGS_CACHE_PATH, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, keys=np.array(list(cached)), embeddings=np.stack(list(cached.values())))
+        os.replace(tmp_path, path)
+
+    return np.stack([cached[digest] for digest in digests])
+
+
+def caculate_similariry(results, data, model, model_name=None, batch_size=SIMILARITY_BATCH_SIZE):
+    """
+    Mean cosine similarity of the predictions and their targets. Both sides are encoded
+    in batches, the targets through the embedding cache of encode_references.
+    """
+
+    qids = list(results)
+    if not qids:
+        return 0.0
+    targets = [data[qid].strip() for qid in qids]
+    predictions = [results[qid] for qid in qids]
 
-        score = similariry_score(target, prediction, model)
-        scores.append(score)
+    target_embeddings = encode_references(targets, model, model_name, batch_size)
+    prediction_embeddings = model.encode(
+        predictions, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
 
-    avg_score = sum(scores) / len(scores)
-    return avg_score
+    # row-wise dot products of normalized embeddings: the cosine of every pair
+    scores = np.einsum("ij,ij->i", target_embeddings, prediction_embeddings)
+    return float(scores.mean())
 
 def accuracy(eval_pred):
     _accuracy = load_metric('accuracy')
@@ -227,6 +227,27 @@ def build_train_pair(problems, test_qid, args, curr_le_data=None):
     return prompt_input, target
 
 
+def build_sample_prompt(sample, args):
+    """
+    Renders a raw sample like build_train_pair renders a ScienceQA problem.
+    sample keys: question, options (list of choices), optional context, caption and rationale
+    """
+
+    problem = {
+        "question": sample["question"],
+        "hint": sample.get("context", ""),
+        "caption": sample.get("caption", ""),
+        "choices": sample["options"],
+        "answer": 0,
+        "lecture": "",
+        "solution": "",
+    }
+    prompt_input, _ = build_train_pair(
+        {"sample": problem}, "sample", args, sample.get("rationale"))
+
+    return prompt_input
+
+
 @dataclass(frozen=True)
 class InputFeatures:
     """
@@ -0,0 +1,293 @@
+import os
+import time
+from typing import Sequence, Tuple
+
+import torch
+import transformers
+from torch import nn
+
+from src import constants
+from src.data.cache import file_digest, object_digest
+from src.models.t5_multimodal_generation.generation import (GenerationEngine,
+                                                            device,
+                                                            ends_with_answer,
+                                                            get_max_new_tokens)
+from src.models.t5_multimodal_generation.onnx_export import EncoderWithFusion
+from src.models.t5_multimodal_generation.quantization import checkpoint_digest
+
+# inputs are right padded to the next bucket, each bucket is one shape the graphs get optimized for
+LENGTH_BUCKETS = (64, 128, 256, 512)
+ENCODER_FILENAME = "encoder.pt"
+# encoder of a multimodal model without the image fusion, for the batches without image_ids
+TEXT_ENCODER_FILENAME = "encoder_text.pt"
+DECODER_FILENAME = "decoder_step.pt"
+
+
+def get_length_bucket(length: int, buckets: Sequence[int] = LENGTH_BUCKETS) -> int:
+    """ Smallest bucket holding length, the length itself if it is longer than every bucket """
+    return next((bucket for bucket in sorted(buckets) if bucket >= length), length)
+
+
+def _split_heads(states: torch.Tensor, attention) -> torch.Tensor:
+    return states.view(states.size(0), -1, attention.n_heads, attention.key_value_proj_dim).transpose(1, 2)
+
+
+def _attend(attention, query_states: torch.Tensor, keys: torch.Tensor, values: torch.Tensor,
+            bias: torch.Tensor) -> torch.Tensor:
+    """ T5Attention without the projections of keys/values: unscaled scores, softmax in fp32 """
+
+    scores = torch.matmul(_split_heads(attention.q(query_states), attention), keys.transpose(3, 2)) + bias
+    weights = nn.functional.softmax(scores.float(), dim=-1).type_as(scores)
+    outputs = torch.matmul(weights, values).transpose(1, 2).reshape(query_states.size(0), -1, attention.inner_dim)
+    return attention.o(outputs)
+
+
+class StaticCacheDecoderStep(nn.Module):
+    """
+    One decoder step of T5 over a preallocated self attention cache of cache_length positions.
+    The keys/values of the step are written in place at position; the positions after it
+    are masked by the precomputed relative position bias, so every step has the same shapes.
+    Takes per layer: self key, self value (batch, heads, cache_length, d_kv) and the
+    cross attention keys/values of EncoderWithFusion. Returns the logits of the step.
+    """
+
+    def __init__(self, model, cache_length: int):
+        super().__init__()
+        self.model = model
+        attention = model.decoder.block[0].layer[0].SelfAttention
+        bias = attention.compute_bias(cache_length, cache_length, device=model.device)
+        future = ~torch.ones((cache_length, cache_length), dtype=torch.bool, device=model.device).tril()
+        self.register_buffer(
+            "self_attention_bias", bias.masked_fill(future, torch.finfo(bias.dtype).min), persistent=False)
+
+    def forward(self, input_ids, position, encoder_attention_bias, *cache):
+        hidden_states = self.model.decoder.embed_tokens(input_ids)
+        self_attention_bias = self.self_attention_bias.index_select(2, position)
+
+        for layer, block in enumerate(self.model.decoder.block):
+            self_keys, self_values, cross_keys, cross_values = cache[4 * layer:4 * layer + 4]
+
+            self_attention = block.layer[0]
+            normed_states = self_attention.layer_norm(hidden_states)
+            attention = self_attention.SelfAttention
+            self_keys.index_copy_(2, position, _split_heads(attention.k(normed_states), attention))
+            self_values.index_copy_(2, position, _split_heads(attention.v(normed_states), attention))
+            hidden_states = hidden_states + _attend(
+                attention, normed_states, self_keys, self_values, self_attention_bias)
+
+            cross_attention = block.layer[1]
+            hidden_states = hidden_states + _attend(
+                cross_attention.EncDecAttention, cross_attention.layer_norm(hidden_states),
+                cross_keys, cross_values, encoder_attention_bias)
+
+            hidden_states = block.layer[2](hidden_states)
+
+        hidden_states = self.model.decoder.final_layer_norm(hidden_states)
+        if self.model.config.tie_word_embeddings:
+            hidden_states = hidden_states * (self.model.model_dim ** -0.5)
+        return self.model.lm_head(hidden_states)[:, -1, :]
+
+
+def get_compiled_model_dir(args, model, max_new_tokens: int, batch_size: int, cache_dir: str = None) -> str:
+    key = object_digest({
+        "checkpoint": checkpoint_digest(args.model),
+        # not the img_type: a multimodal model also runs text only inputs (runner/sweep.py), and
+        # the img_types of one patch shape share the graphs
+        "patch_shape": [model.patch_num, model.patch_dim] if hasattr(model, "fuse_image_features") else None,
+        "quantize": args.quantize,
+        "bf16": args.bf16,
+        "max_new_tokens": max_new_tokens,
+        "batch_size": batch_size,
+        "model_code": file_digest(os.path.join(os.path.dirname(__file__), "model.py")),
+        "encoder_code": file_digest(os.path.join(os.path.dirname(__file__), "onnx_export.py")),
+        "compiled_code": file_digest(__file__),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "device": device,
+    })
+    return os.path.join(cache_dir or constants.COMPILED_MODELS_CACHE_PATH, key)
+
+
+class CompiledGenerationEngine(GenerationEngine):
+    """
+    GenerationEngine running TorchScript graphs of the encoder(+fusion) and of one decoder step.
+    Shapes are static: batches are padded to batch_size rows, inputs to a length bucket, and
+    the decoder attends over a preallocated cache of max_new_tokens positions; finished rows
+    keep their slot (their outputs are discarded) instead of being removed.
+    As in the eager engine, batches without image_ids skip the image fusion of a multimodal model.
+    The traced graphs are saved to model_dir and loaded by the following runs.
+    """
+
+    def __init__(self, model, tokenizer, max_new_tokens: int, model_dir: str, batch_size: int = 8,
+                 length_buckets: Sequence[int] = LENGTH_BUCKETS, **kwargs):
+        super().__init__(model, tokenizer, max_new_tokens, **kwargs)
+        self.model_dir = model_dir
+        self.batch_size = batch_size
+        self.length_buckets = tuple(sorted(length_buckets))
+        self.is_multimodal = hasattr(model, "fuse_image_features")
+        self.text_encoder = None
+        self.stats["compile_seconds"] = 0.0
+
+        start = time.perf_counter()
+        self.encoder, self.decoder = self._load_or_trace()
+        self.stats["compile_seconds"] = round(time.perf_counter() - start, 4)
+
+    @classmethod
+    def from_args(cls, args, model, tokenizer) -> "CompiledGenerationEngine":
+        max_new_tokens = get_max_new_tokens(args)
+        return cls(
+            model,
+            tokenizer,
+            max_new_tokens=max_new_tokens,
+            model_dir=get_compiled_model_dir(args, model, max_new_tokens, args.eval_bs),
+            batch_size=args.eval_bs,
+            repetition_penalty=args.repetition_penalty,
+            bf16=args.bf16,
+            stop_at_answer=not args.no_stop_at_answer and ends_with_answer(args.prompt_format)
+        )
+
+    def reset_stats(self) -> None:
+        compile_seconds = getattr(self, "stats", {}).get("compile_seconds", 0.0)
+        super().reset_stats()
+        self.stats["compile_seconds"] = compile_seconds
+
+    def _example_inputs(self, length: int, with_images: bool = True) -> Tuple:
+        inputs = (torch.ones((self.batch_size, length), dtype=torch.long, device=device),
+                  torch.ones((self.batch_size, length), dtype=torch.long, device=device))
+        if self.is_multimodal and with_images:
+            inputs += (torch.zeros((self.batch_size, self.model.patch_num, self.model.patch_dim), device=device),)
+        return inputs
+
+    def _empty_cache(self, cross_key_values: Sequence[torch.Tensor]) -> list:
+        config = self.model.config
+        shape = (cross_key_values[0].size(0), config.num_heads, self.max_new_tokens, config.d_kv)
+        cache = []
+        for layer in range(config.num_decoder_layers):
+            cache += [torch.zeros(shape, dtype=cross_key_values[0].dtype, device=device),
+                      torch.zeros(shape, dtype=cross_key_values[0].dtype, device=device),
+                      cross_key_values[2 * layer], cross_key_values[2 * layer + 1]]
+        return cache
+
+    def _load_or_trace(self) -> Tuple[torch.jit.ScriptModule, torch.jit.ScriptModule]:
+        encoder_path = os.path.join(self.model_dir, ENCODER_FILENAME)
+        decoder_path = os.path.join(self.model_dir, DECODER_FILENAME)
+        if os.path.exists(encoder_path) and os.path.exists(decoder_path):
+            print(f"[Compile]: Loading the TorchScript graphs from {self.model_dir}")
+            return (torch.jit.load(encoder_path, map_location=device),
+                    torch.jit.load(decoder_path, map_location=device))
+
+        print(f"[Compile]: Tracing the encoder and the decoder step to {self.model_dir}")
+        self.model.eval()
+        example_inputs = self._example_inputs(self.length_buckets[0])
+        with torch.no_grad(), self._autocast():
+            encoder = EncoderWithFusion(self.model).eval()
+            hidden_states, *cross_key_values = encoder(*example_inputs)
+            encoder = torch.jit.freeze(torch.jit.trace(encoder, example_inputs, check_trace=False))
+
+            decoder_inputs = (
+                torch.zeros((self.batch_size, 1), dtype=torch.long, device=device),
+                torch.zeros(1, dtype=torch.long, device=device),
+                self._encoder_attention_bias(example_inputs[1], hidden_states.dtype),
+                *self._empty_cache(cross_key_values))
+            decoder = StaticCacheDecoderStep(self.model, self.max_new_tokens).eval()
+            decoder = torch.jit.freeze(torch.jit.trace(decoder, decoder_inputs, check_trace=False))
+
+        for module, path in ((encoder, encoder_path), (decoder, decoder_path)):
+            self._save(module, path)
+        return encoder, decoder
+
+    def _save(self, module: torch.jit.ScriptModule, path: str) -> None:
+        os.makedirs(self.model_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.jit.save(module, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _get_text_encoder(self) -> torch.jit.ScriptModule:
+        """ Encoder graph without the image fusion, loaded or traced on the first batch without image_ids """
+
+        if self.text_encoder is None:
+            start = time.perf_counter()
+            path = os.path.join(self.model_dir, TEXT_ENCODER_FILENAME)
+            if os.path.exists(path):
+                self.text_encoder = torch.jit.load(path, map_location=device)
+            else:
+                print(f"[Compile]: Tracing the encoder without image fusion to {self.model_dir}")
+                example_inputs = self._example_inputs(self.length_buckets[0], with_images=False)
+                with torch.no_grad(), self._autocast():
+                    self.text_encoder = torch.jit.freeze(torch.jit.trace(
+                        EncoderWithFusion(self.model).eval(), example_inputs, check_trace=False))
+                self._save(self.text_encoder, path)
+            self.stats["compile_seconds"] = round(self.stats["compile_seconds"] + time.perf_counter() - start, 4)
+        return self.text_encoder
+
+    @staticmethod
+    def _encoder_attention_bias(attention_mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+        return (1.0 - attention_mask[:, None, None, :].to(dtype)) * torch.finfo(dtype).min
+
+    def _pad_batch(self, batch: dict) -> Tuple[int, tuple]:
+        """ Pads the rows to batch_size and the inputs to their length bucket """
+
+        input_ids = batch["input_ids"].to(device)
+        num_rows, length = input_ids.shape
+        shape = (self.batch_size, get_length_bucket(length, self.length_buckets))
+        padded_input_ids = torch.full(shape, self.tokenizer.pad_token_id, dtype=torch.long, device=device)
+        padded_input_ids[:num_rows, :length] = input_ids
+        attention_mask = torch.zeros(shape, dtype=torch.long, device=device)
+        attention_mask[:num_rows, :length] = batch["attention_mask"].to(device)
+        inputs = (padded_input_ids, attention_mask)
+
+        if self.is_multimodal and batch.get("image_ids") is not None:
+            image_ids = torch.zeros((self.batch_size, self.model.patch_num, self.model.patch_dim), device=device)
+            image_ids[:num_rows] = batch["image_ids"].to(device).reshape(num_rows, *image_ids.shape[1:])
+            inputs += (image_ids,)
+        return num_rows, inputs
+
+    def generate_ids(self, batch: dict) -> torch.Tensor:
+        num_rows = len(batch["input_ids"])
+        if num_rows > self.batch_size:
+            # larger batches (infer_batch) run in chunks of batch_size rows
+            chunks = [self.generate_ids({key: value[start:start + self.batch_size] for key, value in batch.items()})
+                      for start in range(0, num_rows, self.batch_size)]
+            sequences = torch.full((num_rows, max(chunk.size(1) for chunk in chunks)),
+                                   self.tokenizer.pad_token_id, dtype=torch.long, device=device)
+            for start, chunk in zip(range(0, num_rows, self.batch_size), chunks):
+                sequences[start:start + len(chunk), :chunk.size(1)] = chunk
+            return sequences
+
+        num_rows, inputs = self._pad_batch(batch)
+        encoder = self._get_text_encoder() if self.is_multimodal and batch.get("image_ids") is None else self.encoder
+
+        with torch.inference_mode(), self._autocast():
+            hidden_states, *cross_key_values = encoder(*inputs)
+            encoder_attention_bias = self._encoder_attention_bias(inputs[1], hidden_states.dtype)
+            cache = self._empty_cache(cross_key_values)
+            positions = torch.arange(self.max_new_tokens, device=device)
+
+            sequences = torch.full((self.batch_size, self.max_new_tokens + 1),
+                                   self.tokenizer.pad_token_id, dtype=torch.long, device=device)
+            sequences[:, 0] = self.model.config.decoder_start_token_id
+            # padding rows count as finished from the start
+            finished = torch.arange(self.batch_size, device=device) >= num_rows
+            next_tokens = sequences[:, 0]
+            length = 1
+
+            while length <= self.max_new_tokens and not finished.all():
+                scores = self.decoder(next_tokens.unsqueeze(1), positions[length - 1:length],
+                                      encoder_attention_bias, *cache)
+                if self.logits_processor is not None:
+                    scores = self.logits_processor(sequences[:, :length], scores)
+
+                next_tokens = scores.argmax(dim=-1).masked_fill(finished, self.tokenizer.pad_token_id)
+                sequences[:, length] = next_tokens
+                length += 1
+                # padding and finished rows are computed too, shapes are static
+                self.stats["decoder_row_steps"] += self.batch_size
+
+                active = (~finished).nonzero().flatten()
+                done = next_tokens[active] == self.model.config.eos_token_id
+                if self.stopper is not None:
+                    done |= self.stopper(sequences[active, :length], next_tokens[active])
+                finished[active[done]] = True
+
+            self.stats["static_row_steps"] += num_rows * (length - 1)
+            return sequences[:num_rows, :length]
@@ -0,0 +1,242 @@
+import time
+from collections import deque
+from typing import Iterable, Iterator, List, Tuple
+
+import torch
+import torch.nn.functional as F
+
+from src.data.batching import GENERATION_KEYS
+from src.models.t5_multimodal_generation.generation import (
+    GenerationEngine, encode_batch, select_cache_rows)
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def _pad_left(tensor: torch.Tensor, length: int, dim: int, value=0) -> torch.Tensor:
+    missing = length - tensor.size(dim)
+    if missing <= 0:
+        return tensor
+    pad = [0, 0] * (tensor.dim() - dim - 1) + [missing, 0]
+    return F.pad(tensor, pad, value=value)
+
+
+def _pad_right(tensor: torch.Tensor, length: int, dim: int, value=0) -> torch.Tensor:
+    missing = length - tensor.size(dim)
+    if missing <= 0:
+        return tensor
+    pad = [0, 0] * (tensor.dim() - dim - 1) + [0, missing]
+    return F.pad(tensor, pad, value=value)
+
+
+class DecoderSlots:
+    """
+    State of the rows being decoded.
+    The decoder cache is left padded: T5 only uses relative positions, so a row
+    that joined later sees the same distances as if it was decoded alone.
+    Encoder states (and the cross attention cache) are right padded.
+    """
+
+    def __init__(self, pad_token_id: int):
+        self.pad_token_id = pad_token_id
+        self.sample_indexes = []
+        self.sequences = None           # (rows, cache length + 1), left padded with pad tokens
+        self.decoder_mask = None        # (rows, cache length + 1)
+        self.hidden_states = None       # (rows, encoder length, d_model)
+        self.attention_mask = None      # (rows, encoder length)
+        self.past_key_values = None
+        self.generated = None           # (rows,) number of generated tokens
+
+    def __len__(self):
+        return len(self.sample_indexes)
+
+    def add(self, other: "DecoderSlots") -> None:
+        if not len(self):
+            self.__dict__.update(other.__dict__)
+            return
+
+        length = max(self.sequences.size(1), other.sequences.size(1))
+        encoder_length = max(self.hidden_states.size(1), other.hidden_states.size(1))
+
+        def merge(first, second, pad, length, dim, value=0):
+            return torch.cat([pad(first, length, dim, value), pad(second, length, dim, value)])
+
+        self.sequences = merge(self.sequences, other.sequences, _pad_left, length, 1, self.pad_token_id)
+        self.decoder_mask = merge(self.decoder_mask, other.decoder_mask, _pad_left, length, 1)
+        self.hidden_states = merge(self.hidden_states, other.hidden_states, _pad_right, encoder_length, 1)
+        self.attention_mask = merge(self.attention_mask, other.attention_mask, _pad_right, encoder_length, 1)
+        # self attention keys/values lag the sequences by the last (not yet fed) token
+        self.past_key_values = tuple(
+            (
+                merge(layer[0], other_layer[0], _pad_left, length - 1, 2),
+                merge(layer[1], other_layer[1], _pad_left, length - 1, 2),
+                merge(layer[2], other_layer[2], _pad_right, encoder_length, 2),
+                merge(layer[3], other_layer[3], _pad_right, encoder_length, 2),
+            )
+            for layer, other_layer in zip(self.past_key_values, other.past_key_values)
+        )
+        self.sample_indexes = self.sample_indexes + other.sample_indexes
+        self.generated = torch.cat([self.generated, other.generated])
+
+    def keep(self, rows: torch.Tensor) -> None:
+        """ Evicts every other row and trims the padding no remaining row needs """
+
+        self.sample_indexes = [self.sample_indexes[row] for row in rows.tolist()]
+        self.generated = self.generated[rows]
+        self.sequences = self.sequences[rows]
+        self.decoder_mask = self.decoder_mask[rows]
+        self.hidden_states = self.hidden_states[rows]
+        self.attention_mask = self.attention_mask[rows]
+        self.past_key_values = select_cache_rows(self.past_key_values, rows)
+
+        if not len(self):
+            return
+
+        start = int((self.decoder_mask.sum(dim=0) == 0).sum())
+        encoder_length = int(self.attention_mask.sum(dim=1).max())
+        self.sequences = self.sequences[:, start:]
+        self.decoder_mask = self.decoder_mask[:, start:]
+        self.hidden_states = self.hidden_states[:, :encoder_length]
+        self.attention_mask = self.attention_mask[:, :encoder_length]
+        self.past_key_values = tuple(
+            (layer[0][:, :, start:], layer[1][:, :, start:],
+             layer[2][:, :, :encoder_length], layer[3][:, :, :encoder_length])
+            for layer in self.past_key_values
+        )
+
+
+class ContinuousBatchingEngine(GenerationEngine):
+    """
+    Greedy generation that keeps max_batch_size rows in flight.
+    A row that finishes is evicted and the next sample is encoded, fused with its
+    image features and swapped in with its own decoder cache, so one long
+    rationale does not hold the whole batch hostage. Outputs match GenerationEngine.
+    generate() still decodes one static batch (single requests, server).
+    """
+
+    def __init__(self, model, tokenizer, max_new_tokens: int, max_batch_size: int = 8, **kwargs):
+        super().__init__(model, tokenizer, max_new_tokens, **kwargs)
+        self.max_batch_size = max_batch_size
+
+    @classmethod
+    def from_args(cls, args, model, tokenizer) -> "ContinuousBatchingEngine":
+        engine = super().from_args(args, model, tokenizer)
+        engine.max_batch_size = args.eval_bs
+        return engine
+
+    def _prefill(self, samples: List[dict]) -> DecoderSlots:
+        """ Encodes the samples and runs their first decoding step """
+
+        max_length = max(int(sample["attention_mask"].sum()) for sample in samples)
+        # samples come from batches trimmed to different lengths
+        input_ids = torch.stack([
+            _pad_right(sample["input_ids"][:max_length], max_length, 0, self.tokenizer.pad_token_id)
+            for sample in samples]).to(device)
+        attention_mask = torch.stack([
+            _pad_right(sample["attention_mask"][:max_length], max_length, 0)
+            for sample in samples]).to(device)
+        image_ids = None
+        if samples[0].get("image_ids") is not None:
+            image_ids = torch.stack([sample["image_ids"] for sample in samples]).to(device)
+
+        slots = DecoderSlots(self.tokenizer.pad_token_id)
+        slots.sample_indexes = [sample["index"] for sample in samples]
+        slots.hidden_states = encode_batch(self.model, input_ids, attention_mask, image_ids)
+        slots.attention_mask = attention_mask
+        slots.sequences = torch.full((len(samples), 1), self.model.config.decoder_start_token_id,
+                                     dtype=torch.long, device=device)
+        slots.decoder_mask = torch.ones_like(slots.sequences)
+        slots.generated = torch.zeros(len(samples), dtype=torch.long, device=device)
+        return slots
+
+    def _step(self, slots: DecoderSlots) -> torch.Tensor:
+        """ Feeds the last token of every row, returns the rows that finished """
+
+        outputs = self.model(
+            encoder_outputs=(slots.hidden_states,),
+            attention_mask=slots.attention_mask,
+            decoder_input_ids=slots.sequences[:, -1:],
+            decoder_attention_mask=slots.decoder_mask,
+            past_key_values=slots.past_key_values,
+            use_cache=True,
+            return_dict=True
+        )
+        scores = outputs.logits[:, -1, :]
+        if self.logits_processor is not None:
+            scores = self.logits_processor(slots.sequences, scores)
+
+        next_tokens = scores.argmax(dim=-1)
+        slots.past_key_values = outputs.past_key_values
+        slots.sequences = torch.cat([slots.sequences, next_tokens.unsqueeze(1)], dim=1)
+        slots.decoder_mask = F.pad(slots.decoder_mask, (0, 1), value=1)
+        slots.generated += 1
+        self.stats["decoder_row_steps"] += len(slots)
+
+        finished = (next_tokens == self.model.config.eos_token_id) | (slots.generated >= self.max_new_tokens)
+        if self.stopper is not None:
+            finished |= self.stopper(slots.sequences, next_tokens)
+        return finished
+
+    def _decode(self, slots: DecoderSlots, row: int) -> str:
+        tokens = slots.sequences[row][slots.decoder_mask[row].bool()]
+        self.stats["generated_tokens"] += int((tokens[1:] != self.tokenizer.pad_token_id).sum())
+        return self.tokenizer.decode(tokens, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+
+    def iterate(self, batches: Iterable[dict]) -> Iterator[Tuple[int, str]]:
+        """ Generates every sample of the batches and yields (index, prediction) pairs as rows finish """
+
+        batches = iter(batches)
+        pending = deque()
+        slots = DecoderSlots(self.tokenizer.pad_token_id)
+
+        def fill_pending(count: int) -> None:
+            while len(pending) < count:
+                batch = next(batches, None)
+                if batch is None:
+                    return
+                for row, index in enumerate(batch["index"].tolist()):
+                    sample = {key: batch[key][row] for key in GENERATION_KEYS if key in batch}
+                    sample["index"] = index
+                    pending.append(sample)
+
+        while True:
+            start = time.perf_counter()
+            done = []
+            with torch.inference_mode(), self._autocast():
+                free = self.max_batch_size - len(slots)
+                fill_pending(free)
+                if free and pending:
+                    admitted = [pending.popleft() for _ in range(min(free, len(pending)))]
+                    new_slots = self._prefill(admitted)
+                    done += self._evict(new_slots, self._step(new_slots))
+                    if len(new_slots):
+                        slots.add(new_slots)
+
+                if len(slots):
+                    done += self._evict(slots, self._step(slots))
+
+            self.stats["seconds"] += time.perf_counter() - start
+            self.stats["samples"] += len(done)
+            yield from done
+
+            if not len(slots) and not pending:
+                fill_pending(1)
+                if not pending:
+                    return
+
+    def _evict(self, slots: DecoderSlots, finished: torch.Tensor) -> List[Tuple[int, str]]:
+        """ Removes the finished rows and returns their (index, prediction) pairs """
+
+        if not finished.any():
+            return []
+        done = [
+            (slots.sample_indexes[row], self._decode(slots, row))
+            for row in finished.nonzero().flatten().tolist()
+        ]
+        slots.keep((~finished).nonzero().flatten())
+        return done
+
+    def report(self) -> dict:
+        report = super().report()
+        # every decoder row step is useful work, there is no static batch to compare with
+        report.pop("static_row_steps")
+        return report
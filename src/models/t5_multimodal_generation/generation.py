@@ -0,0 +1,210 @@
+import time
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import torch
+from transformers import RepetitionPenaltyLogitsProcessor
+
+from src.models.t5_multimodal_generation.utils import ANSWER_PATTERN
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def get_max_new_tokens(args) -> int:
+    """
+    Output budget of the task: --output_len is 512 for the rationale stage
+    (QCM-LE) and 64 for the answer stage in the reference commands
+    """
+    return args.output_len
+
+
+def ends_with_answer(prompt_format: str) -> bool:
+    """ True if the target ends with 'The answer is (X).' (QCM-A, QCMG-A, QCM-LEA, ...) """
+    return prompt_format.split("-")[-1].endswith("A")
+
+
+def encode_batch(model, input_ids: torch.Tensor, attention_mask: torch.Tensor,
+                 image_ids: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """ Encoder states of a batch, fused with the image features for T5ForMultimodalGeneration """
+
+    hidden_states = model.get_encoder()(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        return_dict=True
+    ).last_hidden_state
+
+    if image_ids is not None:
+        hidden_states = model.fuse_image_features(hidden_states, image_ids)
+    return hidden_states
+
+
+def select_cache_rows(past_key_values: tuple, rows: torch.Tensor) -> tuple:
+    """ Keeps the given batch rows of the decoder cache (self and cross attention keys/values of every layer) """
+    return tuple(
+        tuple(state.index_select(0, rows) for state in layer_past)
+        for layer_past in past_key_values
+    )
+
+
+class AnswerStopper:
+    """
+    Detects the rows that emitted the answer pattern extract_ans looks for.
+    Only rows whose last token contains ')' are decoded.
+    The lookup table covers the vocab_size logits of the model, which can
+    exceed the tokenizer (T5 pads its vocabulary to 32128 ids).
+    """
+
+    def __init__(self, tokenizer, vocab_size: int):
+        self.tokenizer = tokenizer
+        tokens = tokenizer.convert_ids_to_tokens(list(range(min(len(tokenizer), vocab_size))))
+        self.closing_tokens = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+        self.closing_tokens[:len(tokens)] = torch.tensor(
+            [token is not None and ")" in token for token in tokens], dtype=torch.bool)
+
+    def __call__(self, sequences: torch.Tensor, next_tokens: torch.Tensor) -> torch.Tensor:
+        finished = torch.zeros_like(next_tokens, dtype=torch.bool)
+        candidates = self.closing_tokens[next_tokens].nonzero().flatten().tolist()
+        for row in candidates:
+            text = self.tokenizer.decode(sequences[row], skip_special_tokens=True)
+            finished[row] = ANSWER_PATTERN.search(text) is not None
+        return finished
+
+
+class GenerationEngine:
+    """
+    Batched greedy generation for T5ForMultimodalGeneration and T5ForConditionalGeneration.
+    The encoder (and the image fusion) runs once per batch, the decoder reuses its
+    key/value cache. Rows that emit EOS, or the answer pattern if stop_at_answer is set,
+    are removed from the decoder batch so they stop consuming compute.
+    Runs under torch.inference_mode (and bf16 autocast on CPU if requested).
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_new_tokens: int,
+        repetition_penalty: float = 1.0,
+        bf16: bool = False,
+        stop_at_answer: bool = False
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_new_tokens = max_new_tokens
+        self.repetition_penalty = repetition_penalty
+        self.bf16 = bf16
+        self.stopper = AnswerStopper(tokenizer, model.config.vocab_size) if stop_at_answer else None
+        self.logits_processor = RepetitionPenaltyLogitsProcessor(
+            repetition_penalty) if repetition_penalty != 1.0 else None
+        self.reset_stats()
+
+    @classmethod
+    def from_args(cls, args, model, tokenizer) -> "GenerationEngine":
+        return cls(
+            model,
+            tokenizer,
+            max_new_tokens=get_max_new_tokens(args),
+            repetition_penalty=args.repetition_penalty,
+            bf16=args.bf16,
+            stop_at_answer=not args.no_stop_at_answer and ends_with_answer(args.prompt_format)
+        )
+
+    def reset_stats(self) -> None:
+        self.stats = {"samples": 0, "generated_tokens": 0, "seconds": 0.0,
+                      "decoder_row_steps": 0, "static_row_steps": 0}
+
+    def _autocast(self):
+        return torch.autocast(
+            device_type="cpu", dtype=torch.bfloat16,
+            enabled=self.bf16 and device == "cpu")
+
+    def generate_ids(self, batch: dict) -> torch.Tensor:
+        """ Returns the generated token ids of one collated batch, padded like model.generate """
+
+        image_ids = batch.get("image_ids")
+        attention_mask = batch["attention_mask"].to(device)
+
+        with torch.inference_mode(), self._autocast():
+            hidden_states = encode_batch(
+                self.model, batch["input_ids"].to(device), attention_mask,
+                image_ids.to(device) if image_ids is not None else None)
+
+            batch_size = hidden_states.size(0)
+            sequences = torch.full((batch_size, self.max_new_tokens + 1),
+                                   self.tokenizer.pad_token_id, dtype=torch.long, device=device)
+            sequences[:, 0] = self.model.config.decoder_start_token_id
+
+            active = torch.arange(batch_size, device=device)
+            next_tokens = sequences[:, 0]
+            past_key_values = None
+            length = 1
+
+            while length <= self.max_new_tokens and len(active):
+                outputs = self.model(
+                    encoder_outputs=(hidden_states,),
+                    attention_mask=attention_mask,
+                    decoder_input_ids=next_tokens.unsqueeze(1),
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                    return_dict=True
+                )
+                scores = outputs.logits[:, -1, :]
+                if self.logits_processor is not None:
+                    scores = self.logits_processor(sequences[active, :length], scores)
+
+                next_tokens = scores.argmax(dim=-1)
+                sequences[active, length] = next_tokens
+                length += 1
+                self.stats["decoder_row_steps"] += len(active)
+
+                finished = next_tokens == self.model.config.eos_token_id
+                if self.stopper is not None:
+                    finished |= self.stopper(sequences[active, :length], next_tokens)
+
+                past_key_values = outputs.past_key_values
+                if finished.any():
+                    keep = (~finished).nonzero().flatten()
+                    active = active[keep]
+                    next_tokens = next_tokens[keep]
+                    hidden_states = hidden_states[keep]
+                    attention_mask = attention_mask[keep]
+                    past_key_values = select_cache_rows(past_key_values, keep)
+
+            self.stats["static_row_steps"] += batch_size * (length - 1)
+            return sequences[:, :length]
+
+    def generate(self, batch: dict) -> List[str]:
+        start = time.perf_counter()
+        output_ids = self.generate_ids(batch)
+        self.stats["seconds"] += time.perf_counter() - start
+        self.stats["samples"] += len(output_ids)
+        # the first position is the decoder start token
+        self.stats["generated_tokens"] += int(
+            (output_ids[:, 1:] != self.tokenizer.pad_token_id).sum())
+
+        return self.tokenizer.batch_decode(
+            output_ids, skip_special_tokens=True,
+            clean_up_tokenization_spaces=True
+        )
+
+    def iterate(self, batches: Iterable[dict]) -> Iterator[Tuple[int, str]]:
+        """ Generates every batch and yields (batch['index'], prediction) pairs as they are done """
+
+        for batch in batches:
+            yield from zip(batch["index"].tolist(), self.generate(batch))
+
+    def run(self, batches: Iterable[dict], num_samples: int) -> List[str]:
+        """ Predictions in dataset order (batch['index']) """
+
+        predictions = [None] * num_samples
+        for index, text in self.iterate(batches):
+            predictions[index] = text
+        return predictions
+
+    def report(self) -> dict:
+        seconds = self.stats["seconds"]
+        return {
+            **self.stats,
+            "seconds": round(seconds, 4),
+            "tokens_per_second": round(self.stats["generated_tokens"] / seconds, 2) if seconds else 0.0,
+            "samples_per_second": round(self.stats["samples"] / seconds, 2) if seconds else 0.0,
+        }
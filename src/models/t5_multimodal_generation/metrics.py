@@ -0,0 +1,65 @@
+from functools import lru_cache
+from typing import Iterable, Sequence, Tuple
+
+import evaluate
+import numpy as np
+
+from src.models.t5_multimodal_generation.utils import (extract_answers,
+                                                       postprocess_text)
+
+
+@lru_cache(maxsize=None)
+def load_metric(name: str):
+    """ Metric backends (evaluate.load) are loaded once per process """
+    return evaluate.load(name)
+
+
+def get_token_lengths(tokenizer, texts: Sequence[str]) -> np.ndarray:
+    """ Number of tokens of every text, without special tokens """
+
+    if not len(texts):
+        return np.zeros(0, dtype=np.int64)
+    input_ids = tokenizer(list(texts), add_special_tokens=False)["input_ids"]
+    return np.fromiter((len(ids) for ids in input_ids), dtype=np.int64, count=len(input_ids))
+
+
+def compute_metrics_rougel(tokenizer, predictions, targets):
+    """
+    ROUGE-L metric for Rational generation
+    """
+    return compute_metrics_rougel_batches(tokenizer, [(predictions, targets)])
+
+
+def compute_metrics_rougel_batches(tokenizer, batches: Iterable[Tuple[Sequence[str], Sequence[str]]]):
+    """ ROUGE-L over (predictions, targets) batches, fed to the metric backend as they come """
+
+    metric = load_metric("rouge")
+    num_predictions, num_tokens = 0, 0
+    for predictions, targets in batches:
+        predictions, labels = postprocess_text(predictions, targets)
+        metric.add_batch(predictions=predictions, references=labels)
+        num_predictions += len(predictions)
+        num_tokens += int(get_token_lengths(tokenizer, predictions).sum())
+
+    result = metric.compute(use_stemmer=True)
+    result = {k: round(float(v) * 100, 4) for k, v in result.items()}
+    result["gen_len"] = num_tokens / num_predictions if num_predictions else 0.0
+    return {'rouge-l': result}
+
+
+def compute_metrics_acc(tokenizer, predictions, targets):
+    """
+    Accuracy for Answer inference
+    """
+    return compute_metrics_acc_batches(tokenizer, [(predictions, targets)])
+
+
+def compute_metrics_acc_batches(tokenizer, batches: Iterable[Tuple[Sequence[str], Sequence[str]]]):
+    """ Accuracy over (predictions, targets) batches, only the number of correct answers is kept """
+
+    correct, total = 0, 0
+    for predictions, targets in batches:
+        assert len(predictions) == len(targets)
+        correct += int((extract_answers(predictions) == extract_answers(targets)).sum())
+        total += len(targets)
+    return {'accuracy': correct / total if total else 0.0}
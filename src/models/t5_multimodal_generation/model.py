@@ -15,6 +15,8 @@ from transformers import T5Config, T5ForConditionalGeneration
 from transformers.modeling_outputs import BaseModelOutput, Seq2SeqLMOutput
 from transformers.models.t5.modeling_t5 import __HEAD_MASK_WARNING_MSG, T5Stack
 
+from src.models.t5_multimodal_generation.onnx_export import export_onnx
+
 
 class T5ForMultimodalGeneration(T5ForConditionalGeneration, ABC):
 
@@ -64,6 +66,12 @@ class T5ForMultimodalGeneration(T5ForConditionalGeneration, ABC):
         self.model_parallel = False
         self.device_map = None
 
+    def __getstate__(self):
+        # the gate.txt handle can't be pickled (torch.save of the int8 model)
+        state = self.__dict__.copy()
+        state.pop("out", None)
+        return state
+
     def forward(
         self,
         input_ids: Optional[torch.LongTensor] = None,
@@ -117,13 +125,9 @@ class T5ForMultimodalGeneration(T5ForConditionalGeneration, ABC):
 
         hidden_states = encoder_outputs[0]
 
-        image_embedding = self.image_dense(image_ids)
-        image_att, _ = self.mha_layer(
-            hidden_states, image_embedding, image_embedding)
-
-        merge = torch.cat([hidden_states, image_att], dim=-1)
-        gate = self.sigmoid(self.gate_dense(merge))
-        hidden_states = (1 - gate) * hidden_states + gate * image_att
+        # image_ids is None when encoder_outputs already hold the fused states (generation)
+        if image_ids is not None:
+            hidden_states = self.fuse_image_features(hidden_states, image_ids)
 
         if self.model_parallel:
             torch.cuda.set_device(self.decoder.first_device)
@@ -199,6 +203,22 @@ class T5ForMultimodalGeneration(T5ForConditionalGeneration, ABC):
             encoder_attentions=encoder_outputs.attentions,
         )
 
+    def fuse_image_features(self, hidden_states: torch.Tensor, image_ids: torch.Tensor) -> torch.Tensor:
+        """ Gated cross-attention fusion of the encoder hidden states with the image features """
+
+        if image_ids.dim() == 2:
+            # Pooled features (batch, patch_dim) are fused as a single patch:
+            # attending over identical patches gives the same output as attending over one
+            image_ids = image_ids.unsqueeze(1)
+
+        image_embedding = self.image_dense(image_ids)
+        image_att, _ = self.mha_layer(
+            hidden_states, image_embedding, image_embedding)
+
+        merge = torch.cat([hidden_states, image_att], dim=-1)
+        gate = self.sigmoid(self.gate_dense(merge))
+        return (1 - gate) * hidden_states + gate * image_att
+
     def _prepare_encoder_decoder_kwargs_for_generation(
         self, inputs_tensor: torch.Tensor, model_kwargs, model_input_name: Optional[str] = None
     ) -> Dict[str, Any]:
@@ -219,8 +239,15 @@ class T5ForMultimodalGeneration(T5ForConditionalGeneration, ABC):
         encoder_kwargs["return_dict"] = True
         encoder_kwargs[model_input_name] = inputs_tensor
 
-        model_kwargs["encoder_outputs"] = encoder(
-            **encoder_kwargs)
+        encoder_outputs = encoder(**encoder_kwargs)
+
+        # 4. fuse the image features once, every decoding step reuses the fused states
+        image_ids = model_kwargs.pop("image_ids", None)
+        if image_ids is not None:
+            encoder_outputs.last_hidden_state = self.fuse_image_features(
+                encoder_outputs.last_hidden_state, image_ids)
+
+        model_kwargs["encoder_outputs"] = encoder_outputs
 
         return model_kwargs
 
@@ -253,20 +280,6 @@ class T5ForMultimodalGeneration(T5ForConditionalGeneration, ABC):
             "image_ids": kwargs.get("image_ids")
         }
 
-    def to_onxx(self):
-
-        dummy_input = {
-            "input_ids": torch.zeros(1, 512).to(torch.long),
-            "decoder_input_ids": torch.tensor([1, self.generation_config.pad_token_id])[None, :],
-            "image_ids": torch.zeros(1, 100, 256).to(torch.float)[None, :],
-        }
-
-        torch.onnx.export(
-            self,
-            dummy_input,
-            "T5ForMultimodalGeneration.onnx",
-            verbose=False,
-            input_names=["input_ids", "image_ids"],
-            output_names=["output"],
-            export_params=False
-        )
+    def to_onnx(self, output_dir: str) -> str:
+        """ Exports the encoder(+fusion) and decoder-with-past graphs, see onnx_export.export_onnx """
+        return export_onnx(self, output_dir)
@@ -0,0 +1,207 @@
+import inspect
+import json
+import os
+from typing import Dict, List, Tuple
+
+import torch
+from torch import nn
+
+from src.data.cache import file_digest, object_digest
+from src.models.t5_multimodal_generation.quantization import checkpoint_digest
+
+ENCODER_FILENAME = "encoder.onnx"
+# encoder of a multimodal model without the image fusion, for the batches without image_ids
+TEXT_ENCODER_FILENAME = "encoder_text.onnx"
+DECODER_FILENAME = "decoder_with_past.onnx"
+CONFIG_FILENAME = "onnx_config.json"
+OPSET_VERSION = 14
+
+
+def get_onnx_dir(args, model, save_dir: str) -> str:
+    """ One folder per checkpoint and exporter code under --onnx_dir (<save_dir>/onnx by default) """
+
+    key = object_digest({
+        "checkpoint": checkpoint_digest(args.model),
+        "patch_shape": [model.patch_num, model.patch_dim] if hasattr(model, "fuse_image_features") else None,
+        "quantize": args.quantize,
+        "model_code": file_digest(os.path.join(os.path.dirname(__file__), "model.py")),
+        "export_code": file_digest(__file__),
+        "torch": torch.__version__,
+    })
+    return os.path.join(args.onnx_dir or os.path.join(save_dir, "onnx"), key)
+
+
+def _cross_attention_layers(model) -> List[nn.Module]:
+    return [block.layer[1].EncDecAttention for block in model.decoder.block]
+
+
+class EncoderWithFusion(nn.Module):
+    """
+    Encoder graph: T5 encoder, image fusion (T5ForMultimodalGeneration only) and the
+    cross attention keys/values of every decoder layer, which stay the same for every decoding step.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, image_ids=None):
+        hidden_states = self.model.get_encoder()(
+            input_ids=input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+        if image_ids is not None:
+            hidden_states = self.model.fuse_image_features(hidden_states, image_ids)
+
+        batch_size = hidden_states.size(0)
+        cross_key_values = []
+        for attention in _cross_attention_layers(self.model):
+            for projection in (attention.k, attention.v):
+                cross_key_values.append(projection(hidden_states).view(
+                    batch_size, -1, attention.n_heads, attention.key_value_proj_dim).transpose(1, 2))
+        return (hidden_states, *cross_key_values)
+
+
+class DecoderWithPast(nn.Module):
+    """
+    Decoder graph: one step with the self attention cache (empty on the first step)
+    and the cross attention keys/values of the encoder graph.
+    Returns the logits of the step and the updated self attention cache.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask, *past):
+        past_key_values = tuple(
+            tuple(past[4 * layer:4 * layer + 4]) for layer in range(len(past) // 4))
+
+        outputs = self.model.decoder(
+            input_ids=decoder_input_ids,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True
+        )
+        sequence_output = outputs.last_hidden_state
+        if self.model.config.tie_word_embeddings:
+            sequence_output = sequence_output * (self.model.model_dim ** -0.5)
+        logits = self.model.lm_head(sequence_output)
+
+        present = [state for layer in outputs.past_key_values for state in layer[:2]]
+        return (logits, *present)
+
+
+def _past_names(num_layers: int) -> List[str]:
+    names = []
+    for layer in range(num_layers):
+        names += [f"past_self_key_{layer}", f"past_self_value_{layer}",
+                  f"cross_key_{layer}", f"cross_value_{layer}"]
+    return names
+
+
+def _export(module: nn.Module, inputs: Tuple, path: str, input_names: List[str],
+            output_names: List[str], dynamic_axes: Dict[str, Dict[int, str]]) -> None:
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript exporter supports dynamic_axes
+        kwargs["dynamo"] = False
+
+    torch.onnx.export(
+        module,
+        inputs,
+        path,
+        input_names=input_names,
+        output_names=output_names,
+        dynamic_axes=dynamic_axes,
+        opset_version=OPSET_VERSION,
+        do_constant_folding=True,
+        export_params=True,
+        **kwargs
+    )
+
+
+def export_onnx(model, output_dir: str) -> str:
+    """
+    Exports the encoder(+fusion) and the decoder-with-past graphs of a (multimodal) T5 model.
+    Batch, input and cache lengths are dynamic axes; the image features keep the
+    patch shape of the model's img_type (img_shape). Multimodal models get a second
+    encoder graph without the fusion, for the inputs without image features.
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+    model.eval()
+    device = next(model.parameters()).device
+    config = model.config
+    num_layers = config.num_decoder_layers
+    is_multimodal = hasattr(model, "fuse_image_features")
+
+    batch_size, length = 2, 8
+    input_ids = torch.ones((batch_size, length), dtype=torch.long, device=device)
+    attention_mask = torch.ones((batch_size, length), dtype=torch.long, device=device)
+    text_inputs = (input_ids, attention_mask)
+    text_input_names = ["input_ids", "attention_mask"]
+    cross_names = [name for name in _past_names(num_layers) if name.startswith("cross")]
+    encoder_output_names = ["encoder_hidden_states"] + cross_names
+    text_axes = {"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"},
+                 "encoder_hidden_states": {0: "batch", 1: "sequence"}}
+    text_axes.update({name: {0: "batch", 2: "sequence"} for name in cross_names})
+
+    encoder_inputs, encoder_input_names, encoder_axes = text_inputs, text_input_names, text_axes
+    if is_multimodal:
+        encoder_inputs = text_inputs + (torch.zeros((batch_size, model.patch_num, model.patch_dim), device=device),)
+        encoder_input_names = text_input_names + ["image_ids"]
+        encoder_axes = {**text_axes, "image_ids": {0: "batch"}}
+
+    # the wrappers must be in eval mode too: the exporter restores their mode, and with it the model's, afterwards
+    encoder = EncoderWithFusion(model).eval()
+    with torch.no_grad():
+        encoder_outputs = encoder(*encoder_inputs)
+        _export(encoder, encoder_inputs, os.path.join(output_dir, ENCODER_FILENAME),
+                encoder_input_names, encoder_output_names, encoder_axes)
+        if is_multimodal:
+            _export(encoder, text_inputs, os.path.join(output_dir, TEXT_ENCODER_FILENAME),
+                    text_input_names, encoder_output_names, text_axes)
+
+    # a non empty dummy cache, so that its length is traced as a dynamic axis
+    past_length = 3
+    head_shape = (batch_size, config.num_heads, past_length, config.d_kv)
+    past = []
+    for layer in range(num_layers):
+        past += [torch.zeros(head_shape, device=device), torch.zeros(head_shape, device=device),
+                 encoder_outputs[1 + 2 * layer], encoder_outputs[2 + 2 * layer]]
+
+    past_names = _past_names(num_layers)
+    present_names = [name.replace("past_", "present_") for name in past_names if name.startswith("past_")]
+    decoder_axes = {
+        "decoder_input_ids": {0: "batch"},
+        "encoder_hidden_states": {0: "batch", 1: "encoder_sequence"},
+        "encoder_attention_mask": {0: "batch", 1: "encoder_sequence"},
+        "logits": {0: "batch"},
+    }
+    for name in past_names:
+        decoder_axes[name] = {0: "batch", 2: "encoder_sequence" if name.startswith("cross") else "past_sequence"}
+    for name in present_names:
+        decoder_axes[name] = {0: "batch", 2: "present_sequence"}
+
+    with torch.no_grad():
+        _export(
+            DecoderWithPast(model).eval(),
+            (torch.zeros((batch_size, 1), dtype=torch.long, device=device), encoder_outputs[0], attention_mask, *past),
+            os.path.join(output_dir, DECODER_FILENAME),
+            ["decoder_input_ids", "encoder_hidden_states", "encoder_attention_mask"] + past_names,
+            ["logits"] + present_names,
+            decoder_axes)
+
+    with open(os.path.join(output_dir, CONFIG_FILENAME), "w") as f:
+        json.dump({
+            "num_layers": num_layers,
+            "num_heads": config.num_heads,
+            "d_kv": config.d_kv,
+            "decoder_start_token_id": config.decoder_start_token_id,
+            "eos_token_id": config.eos_token_id,
+            "multimodal": is_multimodal,
+            "patch_shape": [model.patch_num, model.patch_dim] if is_multimodal else None,
+        }, f, indent=2)
+
+    return output_dir
@@ -0,0 +1,163 @@
+import json
+import os
+import time
+
+import numpy as np
+import onnxruntime
+import torch
+
+from src.models.t5_multimodal_generation.generation import (GenerationEngine,
+                                                            encode_batch,
+                                                            get_max_new_tokens,
+                                                            ends_with_answer)
+from src.models.t5_multimodal_generation.onnx_export import (
+    CONFIG_FILENAME, DECODER_FILENAME, ENCODER_FILENAME, TEXT_ENCODER_FILENAME)
+
+
+class OnnxGenerationEngine(GenerationEngine):
+    """
+    GenerationEngine running the exported encoder(+fusion) and decoder-with-past
+    graphs on ONNX Runtime (CPU). Same greedy loop: finished rows are dropped
+    from the decoder batch, the answer pattern can end a row, and batches without
+    image_ids run the encoder graph without the image fusion.
+    """
+
+    def __init__(self, onnx_dir: str, model, tokenizer, max_new_tokens: int, num_threads: int = 0, **kwargs):
+        super().__init__(model, tokenizer, max_new_tokens, **kwargs)
+        with open(os.path.join(onnx_dir, CONFIG_FILENAME), "r") as f:
+            self.onnx_config = json.load(f)
+
+        self.onnx_dir = onnx_dir
+        self.session_options = onnxruntime.SessionOptions()
+        self.session_options.intra_op_num_threads = num_threads
+        self.session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.encoder = self._load_session(ENCODER_FILENAME)
+        self.decoder = self._load_session(DECODER_FILENAME)
+        self.text_encoder = None
+
+    def _load_session(self, filename: str) -> onnxruntime.InferenceSession:
+        return onnxruntime.InferenceSession(
+            os.path.join(self.onnx_dir, filename), self.session_options, providers=["CPUExecutionProvider"])
+
+    @classmethod
+    def from_args(cls, args, model, tokenizer, onnx_dir: str = None) -> "OnnxGenerationEngine":
+        return cls(
+            onnx_dir,
+            model,
+            tokenizer,
+            max_new_tokens=get_max_new_tokens(args),
+            num_threads=args.threads_per_worker or 0,
+            repetition_penalty=args.repetition_penalty,
+            stop_at_answer=not args.no_stop_at_answer and ends_with_answer(args.prompt_format)
+        )
+
+    def encode(self, batch: dict) -> list:
+        inputs = {
+            "input_ids": batch["input_ids"].cpu().numpy().astype(np.int64),
+            "attention_mask": batch["attention_mask"].cpu().numpy().astype(np.int64),
+        }
+        if not self.onnx_config["multimodal"]:
+            return self.encoder.run(None, inputs)
+
+        if batch.get("image_ids") is None:
+            if self.text_encoder is None:
+                self.text_encoder = self._load_session(TEXT_ENCODER_FILENAME)
+            return self.text_encoder.run(None, inputs)
+
+        patch_shape = tuple(self.onnx_config["patch_shape"])
+        inputs["image_ids"] = batch["image_ids"].cpu().float().reshape(-1, *patch_shape).numpy()
+        return self.encoder.run(None, inputs)
+
+    def generate_ids(self, batch: dict) -> torch.Tensor:
+        num_layers = self.onnx_config["num_layers"]
+        hidden_states, *cross_key_values = self.encode(batch)
+        attention_mask = batch["attention_mask"].cpu().numpy().astype(np.int64)
+
+        batch_size = hidden_states.shape[0]
+        sequences = torch.full((batch_size, self.max_new_tokens + 1),
+                               self.tokenizer.pad_token_id, dtype=torch.long)
+        sequences[:, 0] = self.onnx_config["decoder_start_token_id"]
+
+        empty = np.zeros((batch_size, self.onnx_config["num_heads"], 0, self.onnx_config["d_kv"]), dtype=np.float32)
+        self_key_values = [empty] * (2 * num_layers)
+        active = np.arange(batch_size)
+        next_tokens = sequences[:, 0]
+        length = 1
+
+        while length <= self.max_new_tokens and len(active):
+            feeds = {
+                "decoder_input_ids": next_tokens.numpy().reshape(-1, 1),
+                "encoder_hidden_states": hidden_states,
+                "encoder_attention_mask": attention_mask,
+            }
+            for layer in range(num_layers):
+                feeds[f"past_self_key_{layer}"] = self_key_values[2 * layer]
+                feeds[f"past_self_value_{layer}"] = self_key_values[2 * layer + 1]
+                feeds[f"cross_key_{layer}"] = cross_key_values[2 * layer]
+                feeds[f"cross_value_{layer}"] = cross_key_values[2 * layer + 1]
+
+            logits, *self_key_values = self.decoder.run(None, feeds)
+            scores = torch.from_numpy(logits[:, -1, :])
+            rows = torch.from_numpy(active)
+            if self.logits_processor is not None:
+                scores = self.logits_processor(sequences[rows, :length], scores)
+
+            next_tokens = scores.argmax(dim=-1)
+            sequences[rows, length] = next_tokens
+            length += 1
+            self.stats["decoder_row_steps"] += len(active)
+
+            finished = next_tokens == self.onnx_config["eos_token_id"]
+            if self.stopper is not None:
+                finished |= self.stopper(sequences[rows, :length], next_tokens.to(self.stopper.closing_tokens.device)).cpu()
+
+            if finished.any():
+                keep = (~finished).nonzero().flatten().numpy()
+                active = active[keep]
+                next_tokens = next_tokens[keep]
+                hidden_states = hidden_states[keep]
+                attention_mask = attention_mask[keep]
+                self_key_values = [state[keep] for state in self_key_values]
+                cross_key_values = [state[keep] for state in cross_key_values]
+
+        self.stats["static_row_steps"] += batch_size * (length - 1)
+        return sequences[:, :length]
+
+
+def check_parity(model, engine: OnnxGenerationEngine, batch: dict, tolerance: float = 1e-3) -> dict:
+    """
+    Compares the ONNX Runtime encoder states and greedy outputs with PyTorch on one batch,
+    raises a RuntimeError if the states differ by more than tolerance or a prediction differs
+    """
+
+    device = next(model.parameters()).device
+    image_ids = batch.get("image_ids")
+    with torch.inference_mode():
+        expected = encode_batch(
+            model, batch["input_ids"].to(device), batch["attention_mask"].to(device),
+            image_ids.to(device) if image_ids is not None else None).float().cpu().numpy()
+    actual = engine.encode(batch)[0]
+
+    torch_engine = GenerationEngine(
+        model, engine.tokenizer, engine.max_new_tokens,
+        repetition_penalty=engine.repetition_penalty, stop_at_answer=engine.stopper is not None)
+    start = time.perf_counter()
+    torch_predictions = torch_engine.generate(batch)
+    torch_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    onnx_predictions = engine.generate(batch)
+    onnx_seconds = time.perf_counter() - start
+    engine.reset_stats()
+
+    parity = {
+        "encoder_max_abs_diff": float(np.abs(expected - actual).max()),
+        "same_predictions": sum(a == b for a, b in zip(torch_predictions, onnx_predictions)),
+        "samples": len(torch_predictions),
+        "torch_seconds": round(torch_seconds, 4),
+        "onnx_seconds": round(onnx_seconds, 4),
+    }
+    print("[ONNX]: parity", parity)
+    if parity["encoder_max_abs_diff"] > tolerance or parity["same_predictions"] != parity["samples"]:
+        raise RuntimeError(
+            f"The ONNX graphs do not match PyTorch (tolerance {tolerance}): {parity}, run with --backend torch")
+    return parity
@@ -0,0 +1,110 @@
+import time
+from typing import Iterable, Iterator, List, Tuple
+
+import torch
+
+from src.models.t5_multimodal_generation.generation import encode_batch
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def get_answer_candidates(options: List[str]) -> List[str]:
+    """ Answer stage targets, the same text build_train_pair and get_label_text produce """
+    return [f"The answer is ({option})." for option in options]
+
+
+class OptionScorer:
+    """
+    Answer inference by scoring instead of generating.
+    The encoder (and the image fusion) runs once per batch, then every candidate
+    answer is scored in one teacher-forced decoder pass and the candidate with the
+    highest log-likelihood is returned. The output always is one of the candidates.
+
+    Has the same interface as GenerationEngine (generate, run, report).
+    batch['num_options'] optionally limits the candidates of each row to the first n.
+    """
+
+    def __init__(self, model, tokenizer, candidates: List[str], bf16: bool = False):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.candidates = candidates
+        self.bf16 = bf16
+
+        tokenized = tokenizer(candidates, padding="longest", return_tensors="pt")
+        self.candidate_ids = tokenized["input_ids"].to(device)
+        self.candidate_mask = tokenized["attention_mask"].to(device)
+        self.decoder_input_ids = model._shift_right(self.candidate_ids)
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        self.stats = {"samples": 0, "scored_candidates": 0, "seconds": 0.0}
+
+    def _autocast(self):
+        return torch.autocast(
+            device_type="cpu", dtype=torch.bfloat16,
+            enabled=self.bf16 and device == "cpu")
+
+    def score(self, batch: dict) -> torch.Tensor:
+        """ Log-likelihood of every candidate, (batch size, number of candidates) """
+
+        num_candidates = len(self.candidates)
+
+        with torch.inference_mode(), self._autocast():
+            image_ids = batch.get("image_ids")
+            hidden_states = encode_batch(
+                self.model, batch["input_ids"].to(device), batch["attention_mask"].to(device),
+                image_ids.to(device) if image_ids is not None else None)
+            batch_size = hidden_states.size(0)
+
+            # row i * num_candidates + j scores candidate j of sample i
+            logits = self.model(
+                encoder_outputs=(hidden_states.repeat_interleave(num_candidates, dim=0),),
+                attention_mask=batch["attention_mask"].to(device).repeat_interleave(num_candidates, dim=0),
+                decoder_input_ids=self.decoder_input_ids.repeat(batch_size, 1),
+                use_cache=False,
+                return_dict=True
+            ).logits
+
+            log_probs = torch.log_softmax(logits.float(), dim=-1)
+            candidate_ids = self.candidate_ids.repeat(batch_size, 1)
+            token_log_probs = log_probs.gather(-1, candidate_ids.unsqueeze(-1)).squeeze(-1)
+            token_log_probs = token_log_probs * self.candidate_mask.repeat(batch_size, 1)
+            scores = token_log_probs.sum(dim=-1).view(batch_size, num_candidates)
+
+        if batch.get("num_options") is not None:
+            num_options = batch["num_options"].to(scores.device).unsqueeze(1)
+            positions = torch.arange(num_candidates, device=scores.device).unsqueeze(0)
+            scores = scores.masked_fill(positions >= num_options, float("-inf"))
+
+        return scores
+
+    def generate(self, batch: dict) -> List[str]:
+        start = time.perf_counter()
+        best = self.score(batch).argmax(dim=-1).tolist()
+        self.stats["seconds"] += time.perf_counter() - start
+        self.stats["samples"] += len(best)
+        self.stats["scored_candidates"] += len(best) * len(self.candidates)
+
+        return [self.candidates[index] for index in best]
+
+    def iterate(self, batches: Iterable[dict]) -> Iterator[Tuple[int, str]]:
+        """ Scores every batch and yields (batch['index'], prediction) pairs as they are done """
+
+        for batch in batches:
+            yield from zip(batch["index"].tolist(), self.generate(batch))
+
+    def run(self, batches: Iterable[dict], num_samples: int) -> List[str]:
+        """ Predictions in dataset order (batch['index']) """
+
+        predictions = [None] * num_samples
+        for index, text in self.iterate(batches):
+            predictions[index] = text
+        return predictions
+
+    def report(self) -> dict:
+        seconds = self.stats["seconds"]
+        return {
+            **self.stats,
+            "seconds": round(seconds, 4),
+            "samples_per_second": round(self.stats["samples"] / seconds, 2) if seconds else 0.0,
+        }
@@ -0,0 +1,92 @@
+import glob
+import os
+from typing import Callable
+
+import torch
+import transformers
+from torch import nn
+
+from src import constants
+from src.data.cache import file_digest, object_digest
+
+WEIGHT_FILE_PATTERNS = ("pytorch_model*.bin", "model*.safetensors")
+
+
+def checkpoint_digest(model_path: str) -> str:
+    """ Digest of the weight files of a local checkpoint, the name itself for hub models """
+
+    weight_files = sorted(
+        path for pattern in WEIGHT_FILE_PATTERNS
+        for path in glob.glob(os.path.join(model_path, pattern)))
+    if not weight_files:
+        return model_path
+    return object_digest([file_digest(path) for path in weight_files])
+
+
+class QuantizedOutputProjection(nn.Module):
+    """
+    Wraps the quantized wo layer of the T5 feed forward blocks, which read
+    wo.weight.dtype to cast their input; a dynamically quantized Linear
+    only has weight() as a method. The int8 marker makes them skip the cast.
+    """
+
+    def __init__(self, linear: nn.Module):
+        super().__init__()
+        self.linear = linear
+        self.register_buffer("weight", torch.empty(0, dtype=torch.int8), persistent=False)
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        return self.linear(hidden_states)
+
+
+def quantize_model(model: nn.Module) -> nn.Module:
+    """
+    Dynamic int8 quantization of every nn.Linear: the T5 attention and feed forward
+    layers, the lm head and the image fusion (image_dense, gate_dense).
+    The single head image attention (nn.MultiheadAttention) stays fp32, PyTorch has
+    no dynamically quantized version of it.
+    """
+
+    model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    for module in model.modules():
+        if isinstance(getattr(module, "wo", None), torch.ao.nn.quantized.dynamic.Linear):
+            module.wo = QuantizedOutputProjection(module.wo)
+    return model
+
+
+def get_quantized_model_path(args, model_path: str, cache_dir: str = None) -> str:
+    key = object_digest({
+        "checkpoint": checkpoint_digest(model_path),
+        "img_type": args.img_type,
+        "model_code": file_digest(os.path.join(os.path.dirname(__file__), "model.py")),
+        "quantization_code": file_digest(__file__),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "engine": torch.backends.quantized.engine,
+    })
+    return os.path.join(cache_dir or constants.QUANTIZED_MODELS_CACHE_PATH, f"{key}.pt")
+
+
+def load_quantized_model(args, model_path: str, load_model: Callable[[], nn.Module]) -> nn.Module:
+    """
+    Returns the int8 model of the checkpoint, quantized once and then read from the disk cache.
+    load_model loads the fp32 model, it is only called on a cache miss.
+    """
+
+    if torch.cuda.is_available():
+        raise ValueError("Dynamic int8 quantization only runs on CPU")
+
+    path = get_quantized_model_path(args, model_path)
+    if os.path.exists(path):
+        print(f"[Model]: Loading the int8 model from {path}")
+        return torch.load(path, weights_only=False)
+
+    print("[Model]: Quantizing to int8")
+    model = quantize_model(load_model())
+    model.eval()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(model, tmp_path)
+    os.replace(tmp_path, path)
+    return model
@@ -1,16 +1,26 @@
 import torch
 from transformers import Seq2SeqTrainingArguments, T5Tokenizer
 
+from src import constants
 from src.data.scienceQA.dataset_img import ScienceQADatasetImg, img_shape
 from src.data.scienceQA.dataset_std import ScienceQADatasetStd
 from src.models.t5_multimodal_generation.model import (
     T5ForConditionalGeneration, T5ForMultimodalGeneration)
+from src.models.t5_multimodal_generation.quantization import \
+    load_quantized_model
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 def get_t5_model(args, tokenizer: T5Tokenizer, save_dir: str):
+    if args.quantize:
+        return load_quantized_model(
+            args, args.model, lambda: _load_t5_model(args, tokenizer, save_dir))
+    return _load_t5_model(args, tokenizer, save_dir)
+
+
+def _load_t5_model(args, tokenizer: T5Tokenizer, save_dir: str):
     if is_img_type_known(args):
-        padding_idx = tokenizer._convert_token_to_id(tokenizer.pad_token)
+        padding_idx = tokenizer.pad_token_id
         patch_size = img_shape[args.img_type]
         model = T5ForMultimodalGeneration.from_pretrained(
             args.model, patch_size=patch_size, padding_idx=padding_idx, save_dir=save_dir)
@@ -25,44 +35,32 @@ def get_training_data(args, dataframe, tokenizer):
     problems = dataframe['problems']
     qids = dataframe['qids']
     train_qids = qids['train']
-    test_qids = qids['test']
     val_qids = qids['val']
 
     if is_img_type_known(args):
         name_maps = dataframe['name_maps']
         image_features = dataframe['image_features']
 
-        train_set = None
-        # train_set = ScienceQADatasetImg(
-        #     problems,
-        #     train_qids,
-        #     tokenizer,
-        #     args.input_len,
-        #     args.output_len,
-        #     args,
-        #     image_features=image_features,
-        #     name_maps=name_maps
-        # )
-        eval_set = ScienceQADatasetImg(
+        # the image rows of the train split are only gathered when training
+        train_set = ScienceQADatasetImg(
             problems,
-            val_qids,
+            train_qids,
             tokenizer,
             args.input_len,
             args.output_len,
             args,
             image_features=image_features,
-            test_le=args.eval_le,
             name_maps=name_maps
-        )
-        test_set = ScienceQADatasetImg(
+        ) if args.task == constants.Task.TRAIN.value else None
+        eval_set = ScienceQADatasetImg(
             problems,
-            test_qids,
+            val_qids,
             tokenizer,
             args.input_len,
             args.output_len,
             args,
             image_features=image_features,
-            test_le=args.test_le,
+            test_le=args.eval_le,
             name_maps=name_maps
         )
     else:
@@ -84,17 +82,36 @@ def get_training_data(args, dataframe, tokenizer):
             args.eval_le,
         )
 
-        test_set = ScienceQADatasetStd(
+    return train_set, eval_set, get_test_data(args, dataframe, tokenizer)
+
+
+def get_test_data(args, dataframe, tokenizer):
+    """ Only the test split, for the tasks that neither train nor validate """
+
+    problems = dataframe['problems']
+    test_qids = dataframe['qids']['test']
+
+    if is_img_type_known(args):
+        return ScienceQADatasetImg(
             problems,
             test_qids,
             tokenizer,
             args.input_len,
             args.output_len,
             args,
-            args.test_le,
+            image_features=dataframe['image_features'],
+            test_le=args.test_le,
+            name_maps=dataframe['name_maps']
         )
-
-    return train_set, eval_set, test_set
+    return ScienceQADatasetStd(
+        problems,
+        test_qids,
+        tokenizer,
+        args.input_len,
+        args.output_len,
+        args,
+        args.test_le,
+    )
 
 
 def get_training_args(args, output_dir):
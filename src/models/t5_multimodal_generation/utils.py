@@ -1,57 +1,31 @@
 import os
 import re
+from typing import Sequence
 
-import evaluate
 import nltk
 import numpy as np
+import pandas as pd
 import torch
 
 from src.constants import PromptFormat, ModelOutput
 
-def compute_metrics_rougel(tokenizer, predictions, targets):
-    """
-    ROUGE-L metric for Rational generation
-    """
-
-    metric = evaluate.load("rouge")
-    predictions, labels = postprocess_text(
-        predictions, targets)
+ANSWER_PATTERN = re.compile(r'The answer is \(([A-Z])\)')
+FAILED = "FAILED"
 
-    result = metric.compute(predictions=predictions,
-                            references=labels, use_stemmer=True)
-    result = {k: round(v * 100, 4) for k, v in result.items()}
-    prediction_lens = [np.count_nonzero(
-        pred != tokenizer.pad_token_id) for pred in predictions]
-    result["gen_len"] = np.mean(prediction_lens)
-    return {'rouge-l': result}
 
-def compute_metrics_acc(tokenizer, predictions, targets):
+def extract_answers(texts: Sequence[str]) -> np.ndarray:
     """
-    Accuracy for Answer inference
+    The option letter ('A', 'B', ...) of every text if the answer pattern occurs
+    exactly once in it, FAILED otherwise, matched by pandas over the whole column
     """
 
-    correct = 0
-    assert len(predictions) == len(targets)
-    for idx, pred in enumerate(predictions):
-        reference = targets[idx]
-        reference = extract_ans(reference)
-        extract_pred = extract_ans(pred)
-        best_option = extract_pred
-        if reference == best_option:
-            correct += 1
-    return {'accuracy': float(correct) / len(targets)}
+    matches = pd.Series(list(texts), dtype=object).str.findall(ANSWER_PATTERN)
+    answers = matches.str[0].where(matches.str.len() == 1, FAILED)
+    return answers.to_numpy(dtype=object)
 
 
 def extract_ans(ans):
-    pattern = re.compile(r'The answer is \(([A-Z])\)')
-    res = pattern.findall(ans)
-
-    if len(res) == 1:
-        answer = res[0]  # 'A', 'B', ...
-    else:
-        answer = "FAILED"
-
-    return answer
+    return extract_answers([ans])[0]
 
 
 def postprocess_text(predictions, labels):
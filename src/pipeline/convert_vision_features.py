@@ -0,0 +1,32 @@
+"""
+Converts the pickled Fakeddit vision features (<split>.npy, dataset.npy)
+to the dense, memory-mappable format next to them.
+"""
+
+import os
+
+from src import constants
+from src.data.vision_features.dense_features import (DenseVisionFeatures,
+                                                     convert_object_npy,
+                                                     get_dense_path)
+
+base_path = constants.FAKEDDIT_VISION_FEATURES_FOLDER_PATH
+
+for folder_name in sorted(os.listdir(base_path)):
+    folder_path = os.path.join(base_path, folder_name)
+    if not os.path.isdir(folder_path):
+        continue
+
+    for file_name in sorted(os.listdir(folder_path)):
+        if not file_name.endswith(".npy"):
+            continue
+
+        npy_path = os.path.join(folder_path, file_name)
+        dense_path = get_dense_path(npy_path)
+        if os.path.exists(dense_path) and os.path.getmtime(dense_path) >= os.path.getmtime(npy_path):
+            continue
+
+        print(f"Converting {npy_path}")
+        convert_object_npy(npy_path, dense_path, model_name=folder_name)
+        features = DenseVisionFeatures(dense_path)
+        print(f"\t{features.shape}, {features.valid.sum()} valid rows")
@@ -6,6 +6,8 @@ import pandas as pd
 from transformers import CLIPVisionModel, DetrForObjectDetection
 
 from src import constants
+from src.data.vision_features.dense_features import (get_dense_path,
+                                                     save_dense_features)
 from src.data.vision_features.detr_extractor import DetrExtractor
 from src.data.vision_features.transformer_extractor import TransformerExtractor
 from src.pipeline.utils import get_images_paths
@@ -56,7 +58,8 @@ whole_features=[]
 for split in ["train", "validation", "test"]:
     print(f"Processing {split}")
     _save_path=os.path.join(base_save_path, f"{split}.npy")
-    whole_features.append(np.load(_save_path, allow_pickle=True))
-whole_features= np.concatenate(whole_features, axis = 0)
-_save_path=os.path.join(base_save_path, "dataset.npy")
-np.save(_save_path, np.asarray(whole_features))
+    split_features=list(np.load(_save_path, allow_pickle=True))
+    save_dense_features(get_dense_path(_save_path), split_features, model_name=model_name)
+    whole_features.extend(split_features)
+_save_path=os.path.join(base_save_path, "dataset.features")
+save_dense_features(_save_path, whole_features, model_name=model_name)
@@ -3,7 +3,6 @@ import logging
 import os
 
 import dvc.api
-import numpy as np
 import pandas as pd
 from torch.utils.data import DataLoader
 from transformers import AutoTokenizer, DefaultDataCollator, Trainer
@@ -11,6 +10,7 @@ from transformers import AutoTokenizer, DefaultDataCollator, Trainer
 from src import constants
 from src.data.fakeddit.dataset import FakedditDataset
 from src.data.scienceQA.dataset_img import img_shape
+from src.data.vision_features.dense_features import open_dense_features
 from src.models.baseline_classifiers.model import (TrainingArguments,
                                                    TransformerClassifier,
                                                    TransformerConfig)
@@ -72,8 +72,8 @@ def get_datasets():
         vision_features = None
         if img_type:
             base_path = VISION_FEATURES_PATHS.get(img_type)
-            vision_features_path = os.path.join(base_path, f"{split_name}.npy")
-            vision_features = np.load(vision_features_path, allow_pickle=True)
+            vision_features_path = os.path.join(base_path, f"{split_name}.features")
+            vision_features = open_dense_features(vision_features_path)
     
         rationales = None
         if use_rationale:
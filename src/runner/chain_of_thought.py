@@ -1,26 +1,77 @@
+import copy
 import json
 import os
 import random
+import resource
+import shutil
+import time
 from datetime import datetime
+from itertools import islice
+from typing import List
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import Dataset
 from tqdm import tqdm
 from transformers import DataCollatorForSeq2Seq, Seq2SeqTrainer, T5Tokenizer
 
 from src import constants
 from src.constants import PromptFormat, Task
+from src.data.batching import (get_evaluation_dataloader, get_input_digests,
+                                merge_padding_reports)
+from src.data.cache import file_digest, object_digest
+from src.data.fakeddit.dataset import get_question_text
+from src.data.fakeddit.labels import get_options
+from src.data.scienceQA.dataset_img import img_shape
+from src.data.tokenization import normalize_text
+from src.models.prompt import build_sample_prompt, build_train_pair
+from src.models.t5_multimodal_generation.compiled_generation import \
+    CompiledGenerationEngine
+from src.models.t5_multimodal_generation.continuous_batching import \
+    ContinuousBatchingEngine
+from src.models.t5_multimodal_generation.generation import GenerationEngine
+from src.models.t5_multimodal_generation.onnx_export import (
+    export_onnx, get_onnx_dir)
+from src.models.t5_multimodal_generation.option_scoring import (
+    OptionScorer, get_answer_candidates)
+from src.models.t5_multimodal_generation.quantization import checkpoint_digest
 from src.models.t5_multimodal_generation.training_params import (
-    get_t5_model, get_training_args)
-from src.models.t5_multimodal_generation.utils import (compute_metrics_acc,
-                                                       compute_metrics_rougel,
+    get_t5_model, get_training_args, is_img_type_known)
+from src.models.t5_multimodal_generation.metrics import (
+    compute_metrics_acc, compute_metrics_acc_batches, compute_metrics_rougel,
+    compute_metrics_rougel_batches)
+from src.models.t5_multimodal_generation.utils import (extract_answers,
                                                        get_backup_dir,
                                                        get_prediction_filename)
 from src.runner.mlflow_logging import MLFlowLogging
+from src.runner.prediction_cache import PredictionCache, get_sample_key
+from src.runner.prediction_checkpoint import PredictionCheckpoint
 from src.runner.runner import Runner
+from src.runner.sharded_evaluation import run_sharded
 from src.utils import set_random_seed   
 
+# arguments that change the predictions, a checkpoint is only resumed if they match
+CHECKPOINT_ARGS = (
+    "model", "evaluate_dir", "dataset", "data_range", "prompt_format", "img_type",
+    "input_len", "output_len", "repetition_penalty", "score_options", "no_stop_at_answer",
+    "test_le", "use_caption", "prompt", "bf16", "backend", "quantize", "compile",
+)
+# arguments besides the checkpoint and the tokenized input that change a prediction
+PREDICTION_CACHE_ARGS = (
+    "prompt_format", "input_len", "output_len", "repetition_penalty", "score_options",
+    "no_stop_at_answer", "bf16", "backend", "quantize", "compile",
+)
+# parity check of a fresh ONNX export when there is no test set to take a batch from
+PARITY_PROMPTS = (
+    "Question: Which of these states is farthest north?\n"
+    "Context: N/A\nOptions: (A) West Virginia (B) Louisiana (C) Arizona (D) Oklahoma\nSolution:",
+    "Question: Is this post fake news?\nContext: a cat was elected mayor of a small town\n"
+    "Options: (A) true (B) satire (C) misleading content\nSolution:",
+)
+# predictions read back from the checkpoint at a time for the output file and the metrics
+METRICS_CHUNK_SIZE = 1024
+
+
 class ChainOfThought(Runner):
 
     def __init__(
@@ -38,7 +89,13 @@ class ChainOfThought(Runner):
         self.test_set = None
 
         self.t5_model = None
+        self.model = None
+        self.rationale_model = None
         self.tokenizer = None
+        self._generation_engine = None
+        self._option_scorer = None
+        self._input_digests = {}
+        self._sample_keys = {}
 
         self.save_dir = get_backup_dir(args)
         self.filename = get_prediction_filename(args)
@@ -67,15 +124,117 @@ class ChainOfThought(Runner):
         self.model = model
         return self
 
+    def set_rationale_model(self, model):
+        """ QCM-LE checkpoint used by the PIPELINE task, self.model answers """
+        self.rationale_model = model
+        return self
+
     def run(self):
         tasks_map = {
             Task.TRAIN.value: self.train,
             Task.EVALUATE.value: self.evaluate,
-            Task.INFER.value: self.infer
+            Task.INFER.value: self._infer_from_args,
+            Task.PIPELINE.value: self.pipeline
         }
         task = tasks_map.get(self.args.task)
         task()
 
+    def _get_generation_engine(self) -> GenerationEngine:
+        """ The engine is built once and reused as long as the model is not replaced """
+
+        if self._generation_engine is None or self._generation_engine.model is not self.model:
+            if self.args.backend == "onnx":
+                self._generation_engine = self._get_onnx_engine()
+            elif self.args.compile:
+                self._generation_engine = CompiledGenerationEngine.from_args(
+                    self.args, self.model, self.tokenizer)
+            else:
+                engine_class = ContinuousBatchingEngine if self.args.continuous_batching else GenerationEngine
+                self._generation_engine = engine_class.from_args(
+                    self.args, self.model, self.tokenizer)
+        return self._generation_engine
+
+    def _get_onnx_engine(self):
+        """ ONNX Runtime engine over the exported graphs of the checkpoint """
+
+        from src.models.t5_multimodal_generation.onnx_runtime import \
+            OnnxGenerationEngine
+
+        return OnnxGenerationEngine.from_args(self.args, self.model, self.tokenizer, self._export_onnx())
+
+    def _export_onnx(self) -> str:
+        """
+        Folder of the ONNX graphs of the checkpoint, exported if missing. The graphs are
+        exported to a temporary folder and checked against PyTorch on one batch; the folder
+        is only renamed into place if they match, so a reader never sees a partial or unchecked export.
+        """
+
+        from src.models.t5_multimodal_generation.onnx_runtime import (
+            OnnxGenerationEngine, check_parity)
+
+        onnx_dir = get_onnx_dir(self.args, self.model, self.save_dir)
+        if os.path.exists(onnx_dir):
+            return onnx_dir
+
+        print(f"[ONNX]: Exporting the model to {onnx_dir}")
+        tmp_dir = f"{onnx_dir}.{os.getpid()}.tmp"
+        try:
+            export_onnx(self.model, tmp_dir)
+            engine = OnnxGenerationEngine.from_args(self.args, self.model, self.tokenizer, tmp_dir)
+            check_parity(self.model, engine, self._get_parity_batch())
+            try:
+                os.rename(tmp_dir, onnx_dir)
+            except OSError:
+                # exported by another process in the meantime
+                if not os.path.exists(onnx_dir):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return onnx_dir
+
+    def _get_parity_batch(self) -> dict:
+        """ First batch of the test set, or fixed prompts with random image features for inference and the server """
+
+        if self.test_set is not None and len(self.test_set):
+            return next(iter(get_evaluation_dataloader(
+                self.test_set, self.args.eval_bs, range(min(self.args.eval_bs, len(self.test_set))))))
+
+        batch = self._tokenize_prompts([normalize_text(prompt) for prompt in PARITY_PROMPTS])
+        if is_img_type_known(self.args):
+            generator = torch.Generator().manual_seed(self.args.seed)
+            batch["image_ids"] = torch.randn(
+                (len(PARITY_PROMPTS), *img_shape[self.args.img_type]), generator=generator)
+        return batch
+
+    def _get_option_scorer(self, model) -> OptionScorer:
+        """ Scorer over the options of the dataset, the model must be an answer stage (-A) checkpoint """
+
+        if self._option_scorer is None or self._option_scorer.model is not model:
+            self._option_scorer = OptionScorer(
+                model, self.tokenizer, get_answer_candidates(self._get_options()), bf16=self.args.bf16)
+        return self._option_scorer
+
+    def _get_options(self) -> List[str]:
+        if self.args.dataset == constants.DatasetType.FAKEDDIT.value:
+            return get_options(self.test_set.labels_type)
+        return self.args.options
+
+    def _get_num_options(self) -> torch.Tensor:
+        """ Number of options of every test sample, ScienceQA questions have 2 to 5 choices """
+
+        if self.args.dataset == constants.DatasetType.FAKEDDIT.value:
+            return torch.full((len(self.test_set),), len(get_options(self.test_set.labels_type)))
+        return torch.tensor([
+            min(len(self.test_set.data[qid]["choices"]), len(self.args.options))
+            for qid in self.test_set.qids
+        ])
+
+    def _with_num_options(self, batches):
+        num_options = self._get_num_options()
+        for batch in batches:
+            batch["num_options"] = num_options[batch["index"]]
+            yield batch
+
     def _get_run_name(self):
         return "_".join([self.filename, self.args.task, self.args.dataset])
 
@@ -96,44 +255,70 @@ class ChainOfThought(Runner):
             output = {
                 "metrics": [],
                 "predictions": [],
-                "targets": []
+                "targets": [],
+                "padding": {},
+                "generation": {}
             }
 
-            for batch in tqdm(DataLoader(dataset=self.test_set, batch_size=self.args.eval_bs, shuffle=False)):
-
-                kwargs = {}
-                if getattr(self.test_set, 'image_ids', None) is not None:
-                    kwargs['image_ids'] = batch['image_ids']
-
-                out = self.model.generate(
-                    batch['input_ids'],
-                    **kwargs,
-                    repetition_penalty = self.args.repetition_penalty
-                )
-
-                prediction = self.tokenizer.batch_decode(
-                    out, skip_special_tokens=True,
-                    clean_up_tokenization_spaces=True
-                )
-
-                output["predictions"].extend(prediction)
-            # TODO
-            # output["targets"] = 
-            output["targets"] = [el["plain_labels"] for el in self.test_set]
-            output["metrics"] = self._compute_metrics(
-                output["predictions"], output["targets"])
+            if self.args.score_options and not self.args.prompt_format.endswith("-A"):
+                raise ValueError(
+                    f"--score_options needs an answer stage prompt format, got {self.args.prompt_format}")
+
+            checkpoint = self._get_prediction_checkpoint()
+            checkpoint.discard_other_runs()
+            completed = checkpoint.completed_mask(len(self.test_set))
+            remaining = np.flatnonzero(~completed).tolist()
+            if completed.any():
+                print(f"[Evaluation]: Resuming, {int(completed.sum())} of {len(self.test_set)} predictions checkpointed")
+
+            self._input_digests = {}
+            if not self.args.no_dedup or self.args.prediction_cache:
+                self._input_digests = get_input_digests(self.test_set)
+
+            duplicates = {}
+            if not self.args.no_dedup:
+                remaining, duplicates = self._deduplicate(remaining, completed)
+
+            cache = self._get_prediction_cache()
+            cached = 0
+            if cache is not None:
+                num_remaining = len(remaining)
+                remaining = self._read_prediction_cache(cache, remaining)
+                cached = num_remaining - len(remaining)
+
+            if self.args.num_workers > 1:
+                output["generation"] = self._evaluate_sharded(remaining)
+            else:
+                output["generation"] = self._run_shard(remaining, progress=True)
+            output["generation"]["resumed_samples"] = int(completed.sum())
+            output["generation"]["cached_samples"] = cached
+            output["generation"]["duplicate_samples"] = len(duplicates)
+            self._fan_out(checkpoint, duplicates)
+            # padding of the batches that were generated, not of the resumed, cached or duplicate samples
+            output["padding"] = output["generation"].pop("padding")
+            print("[Evaluation]: padding", output["padding"])
+            print("[Evaluation]: generation", output["generation"])
 
             output_prediction_file = os.path.join(
                 self.save_dir, f"predictions_{self.filename}_{datetime.now().strftime(constants.DATE_FORMAT)}.json")
 
+            # the predictions go from the checkpoint to the file and the metrics without being collected
+            del output["predictions"]
             with open(output_prediction_file, "w") as writer:
-                writer.write(json.dumps(output, indent=4))
+                output["metrics"] = self._write_predictions(writer, checkpoint)
+                output["targets"] = list(self.test_set.plain_targets)
+                writer.write(json.dumps(output, indent=4)[1:])
+            checkpoint.remove()
 
             return {
                 **output["metrics"],
                 "task": self.args.task,
                 "dataset": self.args.dataset,
                 "number_of_examples": len(self.test_set),
+                "padding_ratio": output["padding"]["dynamic_padding_ratio"],
+                "tokens_per_second": output["generation"].get("tokens_per_second"),
+                "samples_per_second": output["generation"]["samples_per_second"],
+                "duplicate_samples": output["generation"]["duplicate_samples"],
                 "img_type": self.args.img_type,
                 "output": self.args.prompt_format,
                 "test_le": self.args.test_le,
@@ -141,17 +326,314 @@ class ChainOfThought(Runner):
             }
         return evaluate_mlflow(self)
 
-    def infer(self, sample):
-        # Extract EVALUATE common logic in a private method
-        pass
+    def _get_prediction_checkpoint(self) -> PredictionCheckpoint:
+        """ Predictions of an interrupted evaluation with the same model, arguments and test set """
+
+        # the paths alone would resume a checkpoint after the weights or the rationales were regenerated in place
+        fingerprint = object_digest({
+            "args": {key: getattr(self.args, key, None) for key in CHECKPOINT_ARGS},
+            "checkpoint": checkpoint_digest(self.args.model),
+            "test_le": file_digest(self.args.test_le) if self.args.test_le else None,
+            "targets": list(self.test_set.plain_targets),
+        })
+        return PredictionCheckpoint(
+            os.path.join(self.save_dir, f"predictions_{self.filename}_checkpoint"), fingerprint)
+
+    def _deduplicate(self, indices, completed: np.ndarray) -> tuple:
+        """
+        Keeps one test sample per distinct input (input ids and image features).
+        Returns the indices to generate and {duplicate index: index whose prediction it reuses};
+        a duplicate of a checkpointed sample reuses that prediction.
+        """
+
+        sources = {}
+        for index in np.flatnonzero(completed).tolist():
+            sources.setdefault(self._input_digests[index], index)
+
+        unique, duplicates = [], {}
+        for index in indices:
+            digest = self._input_digests[index]
+            if digest in sources:
+                duplicates[index] = sources[digest]
+            else:
+                sources[digest] = index
+                unique.append(index)
+        if duplicates:
+            print(f"[Evaluation]: {len(duplicates)} of {len(indices)} samples duplicate another input, generating {len(unique)}")
+        return unique, duplicates
+
+    def _fan_out(self, checkpoint: PredictionCheckpoint, duplicates: dict) -> None:
+        """ Checkpoints the prediction of every duplicate, copied from the sample it duplicates """
+
+        if not duplicates:
+            return
+        predictions = checkpoint.load_indices(set(duplicates.values()))
+        with checkpoint.writer() as write:
+            for index, source in duplicates.items():
+                write(index, predictions[source])
+
+    def _get_prediction_cache(self):
+        if not self.args.prediction_cache:
+            return None
+        return PredictionCache(self.args.prediction_cache_mb * 1024 * 1024)
+
+    def _get_prediction_cache_run_key(self) -> str:
+        return object_digest({
+            "checkpoint": checkpoint_digest(self.args.model),
+            "args": {key: getattr(self.args, key, None) for key in PREDICTION_CACHE_ARGS},
+            "options": self._get_options() if self.args.score_options else None,
+        })
+
+    def _read_prediction_cache(self, cache: PredictionCache, indices) -> list:
+        """ Checkpoints the cached predictions of the test samples at indices, returns the indices left to generate """
+
+        run_key = self._get_prediction_cache_run_key()
+        self._sample_keys = {index: get_sample_key(run_key, self._input_digests[index]) for index in indices}
+        found = cache.get_many(self._sample_keys.values())
+        if found:
+            print(f"[Evaluation]: {len(found)} of {len(indices)} predictions found in the prediction cache")
+            with self._get_prediction_checkpoint().writer() as write:
+                for index in indices:
+                    if self._sample_keys[index] in found:
+                        write(index, found[self._sample_keys[index]])
+        return [index for index in indices if self._sample_keys[index] not in found]
+
+    def _run_shard(self, indices, rank: int = None, progress: bool = False) -> dict:
+        """ Writes the predictions of the test samples at indices to the checkpoint as they are done """
+
+        engine = self._get_option_scorer(self.model) if self.args.score_options else self._get_generation_engine()
+        engine.reset_stats()
+
+        dataloader = get_evaluation_dataloader(self.test_set, self.args.eval_bs, indices)
+        batches = dataloader
+        if progress:
+            batches = tqdm(batches)
+        if self.args.score_options:
+            batches = self._with_num_options(batches)
+
+        cache = self._get_prediction_cache()
+        cache_entries = []
+        with self._get_prediction_checkpoint().writer(rank) as write:
+            for index, prediction in engine.iterate(batches):
+                write(index, prediction)
+                if cache is not None:
+                    cache_entries.append((self._sample_keys[index], prediction))
+                    if len(cache_entries) >= self.args.eval_bs:
+                        cache.put_many(cache_entries)
+                        cache_entries = []
+        if cache is not None:
+            cache.put_many(cache_entries)
+
+        return {**engine.report(), "padding": dataloader.batch_sampler.padding_report(self.args.input_len)}
+
+    def _evaluate_sharded(self, indices) -> dict:
+        """ Splits the indices across --num_workers forked CPU processes sharing the loaded model """
+
+        if self.args.backend == "onnx" and not self.args.score_options:
+            # exported (and checked) once here, the forked workers only load the graphs
+            self._export_onnx()
+
+        start = time.perf_counter()
+        reports = run_sharded(
+            self._run_shard, indices, self.args.num_workers, self.args.threads_per_worker)
+        seconds = time.perf_counter() - start
+
+        generated_tokens = sum(report.get("generated_tokens", 0) for report in reports)
+        return {
+            "workers": reports,
+            "padding": merge_padding_reports([report.pop("padding") for report in reports]),
+            "samples": len(indices),
+            "generated_tokens": generated_tokens,
+            "seconds": round(seconds, 4),
+            "tokens_per_second": round(generated_tokens / seconds, 2) if seconds else 0.0,
+            "samples_per_second": round(len(indices) / seconds, 2) if seconds else 0.0,
+        }
 
-    def _compute_metrics(self, predictions, targets):
+    def infer(self, sample: dict) -> dict:
+        """
+        Prediction for one raw sample with the already loaded model and tokenizer.
+        ScienceQA samples: question, options (list of choices), optional context and rationale.
+        Fakeddit samples: title, optional rationale.
+        Both accept optional image_ids, the vision features of the sample image.
+        """
+        return self.infer_batch([sample])[0]
+
+    def infer_batch(self, samples: List[dict]) -> List[dict]:
+        """ Predictions for several raw samples (see infer) generated as one batch """
+
+        start = time.perf_counter()
+        batch = self._build_inference_batch(samples)
+        predictions = self._get_generation_engine().generate(batch)
+        latency_ms = round((time.perf_counter() - start) * 1000, 2)
+
+        return [
+            {
+                "prediction": prediction,
+                "answer": answer,
+                "latency_ms": latency_ms
+            }
+            for prediction, answer in zip(predictions, extract_answers(predictions))
+        ]
+
+    def _build_inference_batch(self, samples: List[dict]) -> dict:
+        texts = []
+        for sample in samples:
+            if self.args.dataset == constants.DatasetType.FAKEDDIT.value:
+                text = get_question_text(
+                    self.args.prompt, sample["title"], sample.get("rationale", ""))
+            else:
+                text = build_sample_prompt(sample, self.args)
+            texts.append(normalize_text(text))
+
+        batch = self._tokenize_prompts(texts)
+
+        if is_img_type_known(self.args):
+            shape = img_shape[self.args.img_type]
+            image_ids = torch.zeros((len(samples), *shape))
+            for index, sample in enumerate(samples):
+                if sample.get("image_ids") is not None and len(sample["image_ids"]):
+                    image_ids[index] = torch.as_tensor(
+                        sample["image_ids"], dtype=torch.float).reshape(shape)
+            batch["image_ids"] = image_ids
+
+        return batch
+
+    def _tokenize_prompts(self, texts: List[str]) -> dict:
+        return dict(self.tokenizer(
+            texts,
+            max_length=self.args.input_len,
+            truncation=True,
+            padding="longest",
+            return_tensors="pt"
+        ))
+
+    def pipeline(self) -> dict:
+        """
+        Rationale generation (QCM-LE) and answer inference (QCMG-A) in a single pass.
+        Every rationale batch is turned into answer prompts right away and
+        generated with the same image features, without intermediate files.
+        """
+
+        start = time.perf_counter()
+        num_samples = len(self.test_set)
+        output = {
+            "metrics": {},
+            "rationales": [None] * num_samples,
+            "predictions": [None] * num_samples,
+            "targets": [None] * num_samples,
+            "pipeline": {}
+        }
+
+        rationale_engine = GenerationEngine(
+            self.rationale_model, self.tokenizer,
+            max_new_tokens=self.args.rationale_output_len,
+            repetition_penalty=self.args.repetition_penalty,
+            bf16=self.args.bf16)
+        if self.args.score_options:
+            answer_engine = self._get_option_scorer(self.model)
+            answer_engine.reset_stats()
+            num_options = self._get_num_options()
+        else:
+            answer_engine = GenerationEngine.from_args(self.args, self.model, self.tokenizer)
+
+        for batch in tqdm(get_evaluation_dataloader(self.test_set, self.args.eval_bs)):
+            indexes = batch["index"].tolist()
+            rationales = rationale_engine.generate(batch)
+
+            prompts = []
+            for index, rationale in zip(indexes, rationales):
+                prompt, target = self._build_answer_pair(index, rationale)
+                prompts.append(normalize_text(prompt))
+                output["rationales"][index] = rationale
+                output["targets"][index] = target
+
+            answer_batch = self._tokenize_prompts(prompts)
+            if "image_ids" in batch:
+                answer_batch["image_ids"] = batch["image_ids"]
+            if self.args.score_options:
+                answer_batch["num_options"] = num_options[batch["index"]]
+
+            for index, prediction in zip(indexes, answer_engine.generate(answer_batch)):
+                output["predictions"][index] = prediction
+
+        output["metrics"] = compute_metrics_acc(self.tokenizer, output["predictions"], output["targets"])
+        if self.args.dataset == constants.DatasetType.SCIENCEQA.value:
+            # the QCM-LE targets are the reference rationales, Fakeddit has none
+            output["metrics"].update(compute_metrics_rougel(
+                self.tokenizer, output["rationales"], list(self.test_set.plain_targets)))
+        output["pipeline"] = {
+            "seconds": round(time.perf_counter() - start, 2),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+            "rationale_generation": rationale_engine.report(),
+            "answer_generation": answer_engine.report()
+        }
+        print("[Pipeline]:", output["pipeline"])
+
+        output_prediction_file = os.path.join(
+            self.save_dir, f"predictions_pipeline_{datetime.now().strftime(constants.DATE_FORMAT)}.json")
+
+        with open(output_prediction_file, "w") as writer:
+            writer.write(json.dumps(output, indent=4))
+
+        return {
+            **output["metrics"],
+            "task": self.args.task,
+            "dataset": self.args.dataset,
+            "number_of_examples": num_samples,
+            "seconds": output["pipeline"]["seconds"],
+            "peak_rss_mb": output["pipeline"]["peak_rss_mb"],
+            "img_type": self.args.img_type,
+            "prompt": self.args.prompt
+        }
+
+    def _build_answer_pair(self, index: int, rationale: str):
+        """ Answer stage (QCMG-A) prompt of a test sample given its generated rationale, and its target """
+
+        if self.args.dataset == constants.DatasetType.FAKEDDIT.value:
+            title = str(self.test_set.dataframe["clean_title"].iloc[index])
+            return self.test_set._get_question_text(title, rationale), self.test_set.plain_targets[index]
+
+        answer_args = copy.copy(self.args)
+        answer_args.prompt_format = PromptFormat.QUESTION_CONTEXT_OPTIONS_SOLUTION_ANSWER.value
+        return build_train_pair(
+            self.test_set.data, self.test_set.qids[index], answer_args, rationale)
+
+    def _infer_from_args(self) -> dict:
+        if not self.args.sample:
+            raise ValueError("--sample is required to run the INFER task")
+
+        with open(self.args.sample, "r") as f:
+            sample = json.load(f)
+
+        result = self.infer(sample)
+        print(json.dumps(result, indent=2))
+        return result
+
+    def _write_predictions(self, writer, checkpoint: PredictionCheckpoint) -> dict:
+        """
+        Streams the checkpointed predictions into the "predictions" list of the output file
+        and into the metrics, METRICS_CHUNK_SIZE samples at a time. Returns the metrics.
+        Accuracy only keeps counts; ROUGE-L hands every chunk to the evaluate metric,
+        which buffers the texts in its own cache until the final aggregation.
+        """
 
-        metric = compute_metrics_acc
+        def batches():
+            predictions = checkpoint.iter_predictions(len(self.test_set))
+            targets = self.test_set.plain_targets
+            writer.write('{\n    "predictions": [')
+            start = 0
+            for chunk in iter(lambda: list(islice(predictions, METRICS_CHUNK_SIZE)), []):
+                for position, prediction in enumerate(chunk, start):
+                    writer.write(("," if position else "") + "\n        " + json.dumps(prediction))
+                yield chunk, targets[start:start + len(chunk)]
+                start += len(chunk)
+            writer.write("\n    ]," if start else "],")
+
+        metric = compute_metrics_acc_batches
         if self.args.prompt_format == PromptFormat.QUESTION_CONTEXT_OPTIONS_LECTURE_SOLUTION.value:
-            metric = compute_metrics_rougel
+            metric = compute_metrics_rougel_batches
 
-        return metric(self.tokenizer, predictions, targets)
+        return metric(self.tokenizer, batches())
 
     def build_seq2seq_base_trainer(self, train_set, eval_set):
         """
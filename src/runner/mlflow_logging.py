@@ -2,9 +2,6 @@ from typing import Any
 
 import mlflow
 
-from src.args_parser import parse_args
-args = parse_args()
-
 
 class MLFlowLogging():
     def __init__(self, experiment_name: str = None, run_name: str = None) -> None:
@@ -31,4 +28,5 @@ class MLFlowLogging():
 
                 result = func(*args)
                 mlflow.log_params(result or {})
+                return result
         return wrapper
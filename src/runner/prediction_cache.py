@@ -0,0 +1,80 @@
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import closing
+from typing import Dict, Iterable, List, Tuple
+
+from src import constants
+
+DATABASE_FILE = "predictions.sqlite"
+# seconds a process waits for the lock held by another evaluation worker
+LOCK_TIMEOUT = 60
+
+
+def get_sample_key(run_key: str, input_digest: str) -> str:
+    """ Key of one test sample: the run key (checkpoint and decoding settings) and its input digest """
+    return hashlib.sha256(f"{run_key}:{input_digest}".encode("utf-8")).hexdigest()
+
+
+class PredictionCache:
+    """
+    On-disk memo of predictions (SQLite), shared by every run and evaluation worker.
+    Lookups refresh the last use of an entry; once the stored predictions exceed
+    max_bytes the least recently used ones are evicted.
+    """
+
+    def __init__(self, max_bytes: int, cache_dir: str = None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir or constants.PREDICTIONS_CACHE_PATH
+        self.path = os.path.join(self.cache_dir, DATABASE_FILE)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS predictions ("
+                "key TEXT PRIMARY KEY, prediction TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # one connection per call: evaluation workers are forked and must not share one
+        return sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, str]:
+        keys = list(keys)
+        found = {}
+        with closing(self._connect()) as connection, connection:
+            # SQLite limits the number of parameters of a statement
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                found.update(connection.execute(
+                    f"SELECT key, prediction FROM predictions WHERE key IN ({placeholders})", chunk).fetchall())
+            connection.executemany(
+                "UPDATE predictions SET last_used = ? WHERE key = ?", [(time.time(), key) for key in found])
+        return found
+
+    def put_many(self, entries: List[Tuple[str, str]]) -> None:
+        if not entries:
+            return
+        now = time.time()
+        with closing(self._connect()) as connection, connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO predictions (key, prediction, size, last_used) VALUES (?, ?, ?, ?)",
+                [(key, prediction, len(key) + len(prediction.encode("utf-8")), now) for key, prediction in entries])
+            self._evict(connection)
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        evicted = 0
+        keys = []
+        for key, size in connection.execute("SELECT key, size FROM predictions ORDER BY last_used"):
+            if total - evicted <= self.max_bytes:
+                break
+            keys.append((key,))
+            evicted += size
+        connection.executemany("DELETE FROM predictions WHERE key = ?", keys)
+        print(f"[Cache]: Evicted {len(keys)} predictions ({evicted} bytes)")
@@ -0,0 +1,127 @@
+import glob
+import json
+import os
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+CHECKPOINT_EXTENSION = ".jsonl"
+
+
+class PredictionCheckpoint:
+    """
+    Append-only JSONL files with the predictions written so far, one line per sample.
+    Every file starts with a header holding the fingerprint of the run; files of
+    another run (other model, arguments or test set) are removed by discard_other_runs.
+    Sharded evaluation writes one file per worker: <prefix>.part<rank>.jsonl
+    """
+
+    def __init__(self, prefix: str, fingerprint: str):
+        self.prefix = prefix
+        self.fingerprint = fingerprint
+
+    def _paths(self) -> List[str]:
+        return sorted(glob.glob(f"{glob.escape(self.prefix)}*{CHECKPOINT_EXTENSION}"))
+
+    def _read_header(self, path: str) -> Optional[dict]:
+        with open(path, "r") as f:
+            try:
+                return json.loads(f.readline())
+            except ValueError:
+                return None
+
+    def discard_other_runs(self) -> None:
+        for path in self._paths():
+            header = self._read_header(path)
+            if header is None or header.get("fingerprint") != self.fingerprint:
+                print(f"[Checkpoint]: Discarding {path}, it belongs to another run")
+                os.remove(path)
+
+    def _iter_records(self):
+        """ Yields (file number, byte offset, index, prediction) of every complete record """
+
+        for file_id, path in enumerate(self._paths()):
+            with open(path, "rb") as f:
+                f.readline()
+                offset = f.tell()
+                for line in iter(f.readline, b""):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # last line of a run that was killed while writing
+                        record = None
+                    if record is not None:
+                        yield file_id, offset, record["index"], record["prediction"]
+                    offset += len(line)
+
+    def completed_mask(self, num_samples: int) -> np.ndarray:
+        """ Boolean mask of the samples that already have a prediction """
+
+        mask = np.zeros(num_samples, dtype=bool)
+        for _, _, index, _ in self._iter_records():
+            mask[index] = True
+        return mask
+
+    def load_indices(self, indices: Iterable[int]) -> Dict[int, str]:
+        """ Predictions of the given samples only """
+
+        indices = set(indices)
+        return {
+            index: prediction
+            for _, _, index, prediction in self._iter_records()
+            if index in indices
+        }
+
+    def iter_predictions(self, num_samples: int) -> Iterator[Optional[str]]:
+        """
+        Yields the prediction of every sample in dataset order (None when missing).
+        Only the position of each record on disk is kept, the predictions are read back one by one.
+        """
+
+        file_ids = np.full(num_samples, -1, dtype=np.int32)
+        offsets = np.zeros(num_samples, dtype=np.int64)
+        for file_id, offset, index, _ in self._iter_records():
+            file_ids[index] = file_id
+            offsets[index] = offset
+
+        files = [open(path, "rb") for path in self._paths()]
+        try:
+            for file_id, offset in zip(file_ids.tolist(), offsets.tolist()):
+                if file_id < 0:
+                    yield None
+                    continue
+                files[file_id].seek(offset)
+                yield json.loads(files[file_id].readline())["prediction"]
+        finally:
+            for f in files:
+                f.close()
+
+    @contextmanager
+    def writer(self, rank: int = None):
+        """ Yields write(index, prediction), every record is flushed to disk right away """
+
+        path = self.prefix + (f".part{rank}" if rank is not None else "") + CHECKPOINT_EXTENSION
+        is_new = not os.path.exists(path) or not os.path.getsize(path)
+        if not is_new:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                # terminate a line cut off by a crash, the record itself is skipped on load
+                is_terminated = f.read(1) == b"\n"
+
+        with open(path, "w" if is_new else "a") as f:
+            if is_new:
+                f.write(json.dumps({"fingerprint": self.fingerprint}) + "\n")
+                f.flush()
+            elif not is_terminated:
+                f.write("\n")
+
+            def write(index: int, prediction: str) -> None:
+                f.write(json.dumps({"index": index, "prediction": prediction}) + "\n")
+                f.flush()
+
+            yield write
+
+    def remove(self) -> None:
+        for path in self._paths():
+            os.remove(path)
@@ -17,5 +17,6 @@ class Runner(ABC):
         pass
 
     @abstractmethod
-    def infer(self, sample) -> str:
+    def infer(self, sample: dict) -> dict:
+        """ Generate the textual output for a single sample """
         pass
@@ -0,0 +1,87 @@
+import os
+import queue
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+# run_shard(indices, rank) -> generation report, the predictions are written by the runner itself
+ShardRunner = Callable[[Sequence[int], int], dict]
+
+
+def get_shards(indices: Sequence[int], num_workers: int) -> List[np.ndarray]:
+    """ Contiguous, nearly equal parts of the indices, one per worker """
+    return [shard for shard in np.array_split(np.asarray(indices, dtype=np.int64), num_workers) if len(shard)]
+
+
+def get_threads_per_worker(num_workers: int, threads_per_worker: Optional[int] = None) -> int:
+    """ Threads of every worker so that the workers together use each core once """
+    if threads_per_worker:
+        return threads_per_worker
+    return max(1, (os.cpu_count() or 1) // num_workers)
+
+
+def _pin(rank: int, threads: int) -> None:
+    torch.set_num_threads(threads)
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        first = rank * threads
+        if first + threads <= len(cores):
+            os.sched_setaffinity(0, cores[first:first + threads])
+
+
+def _worker(rank: int, indices: np.ndarray, threads: int, run_shard: ShardRunner, results) -> None:
+    try:
+        _pin(rank, threads)
+        results.put((rank, run_shard(indices, rank), None))
+    except Exception as err:
+        results.put((rank, None, repr(err)))
+
+
+def run_sharded(
+    run_shard: ShardRunner,
+    indices: Sequence[int],
+    num_workers: int,
+    threads_per_worker: Optional[int] = None
+) -> List[dict]:
+    """
+    Splits the indices across num_workers forked processes and returns their reports.
+    The workers are forked after the model is loaded, so they share its weights
+    copy-on-write instead of holding one copy each.
+    """
+
+    threads = get_threads_per_worker(num_workers, threads_per_worker)
+    shards = get_shards(indices, num_workers)
+    print(f"[Evaluation]: {len(shards)} workers, {threads} threads each")
+
+    context = mp.get_context("fork")
+    results = context.Queue()
+    workers = [
+        context.Process(target=_worker, args=(rank, shard, threads, run_shard, results))
+        for rank, shard in enumerate(shards)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # read every result before joining, a worker blocks until its queued data is consumed
+    outputs = []
+    while len(outputs) < len(workers):
+        try:
+            outputs.append(results.get(timeout=1))
+        except queue.Empty:
+            reported = {rank for rank, _, _ in outputs}
+            crashed = [rank for rank, worker in enumerate(workers)
+                       if rank not in reported and worker.exitcode not in (None, 0)]
+            if crashed:
+                for worker in workers:
+                    worker.terminate()
+                raise RuntimeError(f"Sharded evaluation workers {crashed} crashed")
+    for worker in workers:
+        worker.join()
+
+    errors = [error for _, _, error in outputs if error is not None]
+    if errors:
+        raise RuntimeError(f"Sharded evaluation failed: {errors}")
+
+    return [report for _, report, _ in sorted(outputs, key=lambda output: output[0])]
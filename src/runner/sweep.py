@@ -0,0 +1,138 @@
+import copy
+import itertools
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+from transformers import T5TokenizerFast
+
+from src import constants
+from src.data.fakeddit.data import (load_dataframe, load_rationales,
+                                    load_vision_features)
+from src.data.fakeddit.dataset import FakedditDataset
+from src.data.scienceQA.dataset_img import img_shape
+from src.models.t5_multimodal_generation.training_params import (
+    get_t5_model, is_img_type_known)
+from src.models.t5_multimodal_generation.utils import get_backup_dir
+from src.runner.chain_of_thought import ChainOfThought
+from src.runner.mlflow_logging import MLFlowLogging
+from src.utils import parse_range
+
+
+@dataclass(frozen=True)
+class SweepCell:
+    """ One evaluation of the sweep: a prompt and its feature setting (image features, rationales) """
+
+    prompt: str
+    img_type: Optional[str] = None
+    test_le: Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.img_type or 'text'}{'_rationale' if self.test_le else ''}"
+
+
+def parse_setting(setting: str) -> tuple:
+    """ "none", "<img_type>" or "<img_type>:<rationales file>" -> (img_type, test_le) """
+
+    img_type, _, test_le = setting.partition(":")
+    return (None if img_type.lower() == "none" else img_type), (test_le or None)
+
+
+def get_sweep_grid(prompts: Sequence[str], settings: Sequence[str]) -> List[SweepCell]:
+    """ Every prompt with every feature setting, prompt by prompt """
+    return [SweepCell(prompt, *parse_setting(setting)) for prompt, setting in itertools.product(prompts, settings)]
+
+
+class FakedditSweep:
+    """
+    Evaluates a grid of prompts and feature settings in one process. The tokenizer, the
+    checkpoint (once per image patch shape, text only cells reuse it without images),
+    the dataset, the vision features and the rationales are loaded once; every cell only
+    tokenizes its prompts and is logged to MLflow as its own run. Every generation backend
+    skips the image fusion of the multimodal model for the text only cells.
+    """
+
+    def __init__(self, args):
+        if args.dataset != constants.DatasetType.FAKEDDIT.value:
+            raise ValueError(f"The sweep runs on {constants.DatasetType.FAKEDDIT.value}, got {args.dataset}")
+
+        self.args = args
+        self.data_range = parse_range(args.data_range)
+        self.tokenizer = T5TokenizerFast.from_pretrained(pretrained_model_name_or_path=args.model)
+        self.dataframe = load_dataframe()[slice(*self.data_range)]
+        self._models = {}
+        self._text_img_type = None
+        self._vision_features = {}
+        self._rationales = {}
+
+    def _cell_args(self, cell: SweepCell):
+        args = copy.copy(self.args)
+        args.prompt = cell.prompt
+        args.img_type = cell.img_type
+        args.test_le = cell.test_le
+        # the cells share the exported graphs of the checkpoint (--backend onnx)
+        args.onnx_dir = self.args.onnx_dir or os.path.join(get_backup_dir(self.args), "onnx")
+        return args
+
+    def _get_model(self, img_type: Optional[str]):
+        """ Multimodal models are shared by the img_types of one patch shape """
+
+        key = img_shape.get(img_type)
+        if key not in self._models:
+            args = self._cell_args(SweepCell(self.args.prompt, img_type))
+            self._models[key] = get_t5_model(args, self.tokenizer, get_backup_dir(args))
+        return self._models[key]
+
+    def _get_vision_features(self, img_type: Optional[str]):
+        if img_type not in self._vision_features:
+            vision_features = load_vision_features(img_type)
+            self._vision_features[img_type] = \
+                vision_features[slice(*self.data_range)] if vision_features is not None else None
+        return self._vision_features[img_type]
+
+    def _get_rationales(self, path: Optional[str]) -> Optional[List[str]]:
+        if path not in self._rationales:
+            rationales = load_rationales(path)
+            self._rationales[path] = rationales[slice(*self.data_range)] if rationales is not None else None
+        return self._rationales[path]
+
+    def build_chain_of_thought(self, cells: Sequence[SweepCell], index: int) -> ChainOfThought:
+        cell = cells[index]
+        args = self._cell_args(cell)
+        test_set = FakedditDataset(
+            dataframe=self.dataframe,
+            tokenizer=self.tokenizer,
+            vision_features=self._get_vision_features(cell.img_type),
+            rationales=self._get_rationales(cell.test_le),
+            prompt=cell.prompt,
+            use_cache=not args.no_tokenization_cache,
+            dataset_path=constants.FAKEDDIT_DATASET_PATH
+        )
+        chain_of_thought = ChainOfThought(args) \
+            .set_tokenizer(self.tokenizer) \
+            .set_eval_set(test_set) \
+            .set_test_set(test_set) \
+            .set_model(self._get_model(cell.img_type if is_img_type_known(args) else self._text_img_type))
+
+        # one folder per cell: predictions and checkpoints of the cells do not overwrite each other
+        chain_of_thought.save_dir = os.path.join(chain_of_thought.save_dir, "sweep", f"{index:03d}_{cell.name}")
+        os.makedirs(chain_of_thought.save_dir, exist_ok=True)
+        return chain_of_thought
+
+    def run(self, cells: Sequence[SweepCell]) -> List[Dict]:
+        """ Evaluates every cell, returns their metrics in grid order """
+
+        # text only cells run on the multimodal model of the grid (without images), not a second checkpoint copy
+        self._text_img_type = next(
+            (cell.img_type for cell in cells if is_img_type_known(self._cell_args(cell))), None)
+
+        results = []
+        for index, cell in enumerate(cells):
+            print(f"[Sweep]: Cell {index + 1}/{len(cells)} {cell.name}, prompt: {cell.prompt}")
+            chain_of_thought = self.build_chain_of_thought(cells, index)
+            run_name = f"{chain_of_thought._get_run_name()}_{index:03d}_{cell.name}"
+            evaluate = MLFlowLogging(experiment_name=self.args.experiment_name, run_name=run_name)(
+                chain_of_thought.evaluate)
+            results.append(evaluate())
+        return results
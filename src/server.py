@@ -0,0 +1,162 @@
+"""
+Long-running HTTP inference server.
+The tokenizer and the model are loaded once; concurrent requests are queued
+and merged into micro-batches of at most --max_batch_size samples, waiting
+at most --max_wait_ms for a batch to fill up.
+
+    python src/server.py --evaluate_dir models/MM-CoT-UnifiedQA-base-Answer \
+        --img_type cooelf_detr --prompt_format QCMG-A --port 8000
+
+    POST /infer   {"question": ..., "options": [...], "context": ...}  or  {"samples": [...]}
+    GET  /health
+"""
+
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+from dotenv import load_dotenv
+
+from src.args_parser import parse_args
+from src.main import get_inference_cot
+from src.runner.chain_of_thought import ChainOfThought
+
+args = parse_args()
+
+
+class MicroBatcher:
+    """ Merges the queued samples into batches and runs them on a single worker thread """
+
+    def __init__(self, chain_of_thought: ChainOfThought, max_batch_size: int, max_wait_ms: float):
+        self.chain_of_thought = chain_of_thought
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.stats = {"requests": 0, "batches": 0}
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._loop, daemon=True)
+        self._worker.start()
+
+    def submit(self, samples: List[dict]) -> List[Future]:
+        futures = []
+        for sample in samples:
+            future = Future()
+            self.queue.put((sample, future, time.perf_counter()))
+            futures.append(future)
+        return futures
+
+    def _next_batch(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self.chain_of_thought.infer_batch(
+                    [sample for sample, _, _ in batch])
+            except Exception:
+                # isolate the malformed samples instead of failing the whole batch
+                results = [self._infer_one(sample) for sample, _, _ in batch]
+
+            now = time.perf_counter()
+            for (_, future, queued_at), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                    continue
+                future.set_result({
+                    **result,
+                    "batch_size": len(batch),
+                    "total_ms": round((now - queued_at) * 1000, 2)
+                })
+
+            with self._lock:
+                self.stats["requests"] += len(batch)
+                self.stats["batches"] += 1
+
+    def _infer_one(self, sample: dict):
+        try:
+            return self.chain_of_thought.infer(sample)
+        except Exception as err:
+            return err
+
+    def report(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+        stats["mean_batch_size"] = round(
+            stats["requests"] / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+
+    batcher: MicroBatcher = None
+
+    def _send_json(self, status: int, payload) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._send_json(404, {"error": f"unknown path {self.path}"})
+        return self._send_json(200, {"status": "ok", **self.batcher.report()})
+
+    def do_POST(self):
+        if self.path != "/infer":
+            return self._send_json(404, {"error": f"unknown path {self.path}"})
+
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError as err:
+            return self._send_json(400, {"error": f"invalid JSON: {err}"})
+
+        if not isinstance(payload, dict):
+            return self._send_json(400, {"error": "expected a sample object or {\"samples\": [...]}"})
+        is_batch = "samples" in payload
+        samples = payload["samples"] if is_batch else [payload]
+        if not isinstance(samples, list) or not all(isinstance(sample, dict) for sample in samples):
+            return self._send_json(400, {"error": "samples must be a list of sample objects"})
+
+        try:
+            results = [future.result() for future in self.batcher.submit(samples)]
+        except (KeyError, TypeError, ValueError) as err:
+            return self._send_json(400, {"error": f"invalid sample: {err!r}"})
+        except Exception as err:
+            return self._send_json(500, {"error": repr(err)})
+
+        return self._send_json(200, results if is_batch else results[0])
+
+    def log_message(self, format, *log_args):
+        pass
+
+
+if __name__ == '__main__':
+
+    load_dotenv(override=True)
+
+    InferenceHandler.batcher = MicroBatcher(
+        get_inference_cot(), args.max_batch_size, args.max_wait_ms)
+
+    server = ThreadingHTTPServer((args.host, args.port), InferenceHandler)
+    print(f"[Server]: Listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()